@@ -0,0 +1,128 @@
+# Benchmarks for the interpreter hot paths, with a saved baseline for spotting regressions.
+#
+#   python bench.py                      run everything and print a table
+#   python bench.py --quick              only the smallest size of each workload
+#   python bench.py --save base.json     also write the results as a baseline
+#   python bench.py --compare base.json  flag workloads slower than the baseline by --threshold
+
+import argparse, json, sys, time, tracemalloc, tempfile
+import k, parse, compiler, optimize
+
+def nested(depth):
+    "{{{x}x+1}x+1}... : depth lambdas, each calling the next one"
+    body = "x"
+    for _ in range(depth): body = "{%s}x+1" % body
+    return "{%s}" % body
+
+def bwt(n):
+    "The Burrows-Wheeler transform of ^BANANA...|. Rotations come from reshaping to rows one longer than the string."
+    return "{r: ((#x); 1+#x) # x; n: (#x)-1; {x[n]}'r[<r]} \"^%s|\"" % ("BANANA" * n)
+
+def script(n):
+    "A script of n statements, for timing the parser."
+    return "\n".join("a%d: {x[<x]} %d 3 1 4 1 5 # !%d" % (i, i, i) for i in range(n))
+
+# name -> (function from size to K source, sizes). Sizes go through a variable where the input
+# would otherwise be a constant that the optimizer folds before timing starts.
+WORKLOADS = {
+    "vector arith":   (lambda n: "a: !%d; b: 2*a; a+b*a-3" % n, [10**4, 10**6]),
+    "sum of !n":      (lambda n: "+/1+2*!%d" % n, [10**6, 10**9] if k.np is not None else [10**4, 10**6]), # 10**9 needs lazy Ranges
+    "sum of a vec":   (lambda n: "n: %d; +/(n#1 2 3)*2" % n, [10**4, 10**6]),
+    "reshape 2d":     (lambda n: "n: %d; (n; n) # !7" % n, [100, 1000]),
+    "reshape 4d":     (lambda n: "n: %d; (n; n; n; n) # 1 2 3" % n, [5, 20]),
+    "sort":           (lambda n: "n: %d; {x[<x]} n # 3 1 4 1 5 9 2 6 5 3 5 8 9 7 9" % n, [10**3, 10**5]),
+    "sort chars":     (lambda n: 'n: %d; {x[<x]} n # "the quick brown fox"' % n, [10**3, 10**5]),
+    "tails":          (lambda n: "#{1_x}\\ !%d" % n, [100, 1000]),
+    "tails chars":    (lambda n: 'n: %d; #{1_x}\\ n # "abc"' % n, [100, 1000]),
+    "bwt":            (bwt, [10, 100]),
+    "each lambda":    (lambda n: "{x*2}' !%d" % n, [10**3, 10**5]),
+    "over lambda":    (lambda n: "{x+y}/ !%d" % n, [10**3, 10**5]),
+    "each invariant": (lambda n: "a: !100; {x*+/a*a}' !%d" % n, [10**2, 10**4]),
+    "nested lambdas": (lambda n: "%s' !%d" % (nested(50), n), [10, 1000]),
+}
+
+MODES = {
+    "eval": lambda exprs: [k.eval(e) for e in exprs][-1],
+    "compiled": lambda codes: [c(None) for c in codes][-1],
+    "optimized": lambda codes: [c(None) for c in codes][-1],
+}
+
+def measure(run, repeat):
+    """Returns the best wall time of repeat runs, then the peak traced memory of one more run and
+    the blocks still allocated after it, which are mostly those its result holds."""
+    best = float("inf")
+    for _ in range(repeat):
+        k.default.reset()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    k.default.reset()
+    tracemalloc.start()
+    blocks = sys.getallocatedblocks()
+    result = run()
+    retained = sys.getallocatedblocks() - blocks
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return {"time": best, "peak": peak, "retained": retained}
+
+def run_all(quick=False, repeat=3, only=None):
+    results = {}
+    for name, (make, sizes) in WORKLOADS.items():
+        if only and only not in name: continue
+        for n in sizes[:1] if quick else sizes:
+            src = make(n)
+            exprs = parse.parse(src)
+            codes = {"compiled": [compiler.compile(e) for e in exprs],
+                     "optimized": [compiler.compile(optimize.optimize(e)) for e in exprs]}
+            for mode, run in MODES.items():
+                arg = exprs if mode == "eval" else codes[mode]
+                results["%s n=%d %s" % (name, n, mode)] = measure(lambda: run(arg), repeat)
+    for n in [100] if quick else [100, 1000]:
+        src = script(n)
+        results["parse n=%d" % n] = measure(lambda: parse.parse(src), repeat)
+        with tempfile.TemporaryDirectory() as d:
+            parse.parse_cached(src, d)
+            results["parse cached n=%d" % n] = measure(lambda: parse.parse_cached(src, d), repeat)
+    return results
+
+def report(results, baseline=None, threshold=0.2, noise=0.001):
+    """Prints the results, comparing times with the baseline if there is one. Returns the
+    regressions: workloads slower by more than threshold, and by more than noise seconds."""
+    regressions = []
+    print("%-36s %10s %12s %10s %s" % ("workload", "time", "peak", "retained", "vs baseline" if baseline else ""))
+    for key, r in results.items():
+        note = ""
+        if baseline and key in baseline:
+            ratio = r["time"] / baseline[key]["time"]
+            note = "%.2fx" % ratio
+            if ratio > 1 + threshold and r["time"] - baseline[key]["time"] > noise:
+                note += "  REGRESSION"
+                regressions.append(key)
+        print("%-36s %8.2fms %10.1fKB %10d %s" % (key, r["time"]*1e3, r["peak"]/1024, r["retained"], note))
+    return regressions
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the K interpreter")
+    p.add_argument("--quick", action="store_true", help="only run the smallest size of each workload")
+    p.add_argument("--repeat", type=int, default=3, help="take the best time of this many runs")
+    p.add_argument("--only", help="only run workloads whose name contains this")
+    p.add_argument("--save", metavar="FILE", help="write the results to FILE as a baseline")
+    p.add_argument("--compare", metavar="FILE", help="compare the times with the baseline in FILE")
+    p.add_argument("--threshold", type=float, default=0.2, help="how much slower counts as a regression (0.2 = 20%%)")
+    p.add_argument("--noise", type=float, default=0.001, help="ignore slowdowns of fewer seconds than this")
+    args = p.parse_args()
+
+    results = run_all(args.quick, args.repeat, args.only)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f: baseline = json.load(f)["results"]
+    regressions = report(results, baseline, args.threshold, args.noise)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": results}, f, indent=1, sort_keys=True)
+    if regressions:
+        print("%d regressions beyond %d%%" % (len(regressions), args.threshold*100))
+        sys.exit(1)
+
+if __name__ == "__main__": main()
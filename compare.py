@@ -1,17 +1,89 @@
 # Compare our interpreter with the output of oK <https://github.com/JohnEarnest/ok>
 
-import subprocess, json, traceback
+import subprocess, json, traceback, threading, queue, os, sys
 import k, parse
 
+class OracleTimeout(Exception): pass
+
+class Oracle:
+    """A persistent oK worker (okworker.js) speaking line-delimited JSON over stdin/stdout.
+
+    Each batch of expressions is sent as one request line, and the worker answers with one line per
+    expression. If an answer takes longer than timeout seconds, or the worker dies, the worker is
+    restarted and the rest of the batch is resent."""
+
+    def __init__(self, cmd=None, timeout=5.0):
+        self.cmd = cmd or ["node", os.path.join(os.path.dirname(os.path.abspath(__file__)), "okworker.js")]
+        self.timeout = timeout
+        self.proc = None
+        self.restarts = 0
+        self._id = 0
+
+    def start(self):
+        self.proc = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, universal_newlines=True, bufsize=1)
+        self.lines = queue.Queue()
+        # readline can't time out, so a thread feeds the answers into a queue
+        def pump(out, lines):
+            for line in out: lines.put(line)
+            lines.put(None) # EOF, the worker died
+        threading.Thread(target=pump, args=(self.proc.stdout, self.lines), daemon=True).start()
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+
+    def restart(self):
+        self.close()
+        self.restarts += 1
+        self.start()
+
+    def __enter__(self): return self
+    def __exit__(self, *exc): self.close()
+
+    def send(self, exprs):
+        if self.proc is None: self.start()
+        self._id += 1
+        try:
+            self.proc.stdin.write(json.dumps({"id": self._id, "exprs": exprs}) + "\n")
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            pass # noticed as EOF when reading the answers
+        return self._id
+
+    def batch(self, exprs):
+        """Evaluates exprs in oK, returning one dict per expression with either "ast" and "value", or "error".
+        An expression that times out or crashes the worker gets an OracleTimeout or "worker crashed" error."""
+        results = []
+        while len(results) < len(exprs):
+            id = self.send(exprs[len(results):])
+            while len(results) < len(exprs):
+                try: line = self.lines.get(timeout=self.timeout)
+                except queue.Empty:
+                    results.append({"error": OracleTimeout("timed out after %gs" % self.timeout)})
+                    self.restart()
+                    break
+                if line is None:
+                    results.append({"error": "worker crashed"})
+                    self.restart()
+                    break
+                r = json.loads(line)
+                if r.get("id") != id: continue # a late answer from before a restart
+                results.append(r)
+        return results
+
+_oracle = None
+
+def oracle():
+    global _oracle
+    if _oracle is None: _oracle = Oracle()
+    return _oracle
+
 def ok_eval(expr):
-    try:
-        expr = expr.replace("\\", "\\\\") # escape backslashes
-        expr = expr.replace("'", "\\'") # escape single quotes
-        output = subprocess.check_output(["node", "-p", "var ok=require('../ok/ok'); JSON.stringify(ok.run(ok.parse('%s'), ok.baseEnv()))" % expr], stderr=subprocess.STDOUT)
-        return json.loads(output.decode('utf-8'))
-    except subprocess.CalledProcessError as e:
-        #print("eval error")
-        return None
+    r = oracle().batch([expr])[0]
+    return None if "error" in r else r["value"]
 
 def eval(expr):
     v = ok_eval(expr)
@@ -25,10 +97,18 @@ reset = "\033[00m"
 _testsSucceeded = 0
 _testsFailed = 0
 
+_cases = []
+
 def t(expr):
+    _cases.append(expr)
+
+def check(expr, r):
     global _testsSucceeded, _testsFailed
-    res_ok = eval(expr)
+    res_ok = None if "error" in r else parse.to_ast(r["value"])
+    raw_ast = r.get("ast")
     ast = parse.parse(expr)
+    if raw_ast is not None and list(map(parse.to_ast, raw_ast)) != ast:
+        print("NOTE: parse differs from oK for: %s" % expr)
     try:
         res_k = list(map(k.eval, ast))[-1]
     except Exception as e:
@@ -40,7 +120,7 @@ def t(expr):
 
         print(red+"FAIL"+reset+": Got exception %r, expected %r for: %s" % (e, res_ok, expr))
         print("AST: %r" % ast)
-        print("Raw AST: %s" % parse.ast(expr, raw=True))
+        print("Raw AST: %s" % json.dumps(raw_ast))
         traceback.print_exc()
         _testsFailed += 1
         return
@@ -48,13 +128,13 @@ def t(expr):
     if res_k != res_ok:
         print(red+"FAIL"+reset+": Got %r, expected %r for: %s" % (res_k, res_ok, expr))
         print("AST: %r" % ast)
-        print("Raw AST: %s" % parse.ast(expr, raw=True))
+        print("Raw AST: %s" % json.dumps(raw_ast))
         _testsFailed += 1
     else:
         print(green+"SUCC"+reset+": Got %r, expected %r for: %s" % (res_k, res_ok, expr))
         _testsSucceeded += 1
 
-def tests():
+def cases():
     t("1+2")
     t('"abc"')
     t('{x[<x]} "cba"') # sort chars
@@ -170,8 +250,37 @@ def tests():
 
     # TODO: Test more cases of reshape
 
+def tests():
+    del _cases[:]
+    cases()
+    with oracle():
+        for expr, r in zip(_cases, oracle().batch(_cases)):
+            check(expr, r)
+
     print("")
     print("%d tests succeeded, %d tests failed" % (_testsSucceeded, _testsFailed))
 
-
-if __name__ == "__main__": tests()
\ No newline at end of file
+# a stand-in for okworker.js: answers with the length of the expression, hangs on "hang" and exits on "crash"
+STUB = r"""
+import sys, json, time
+for line in sys.stdin:
+    req = json.loads(line)
+    for i, e in enumerate(req["exprs"]):
+        if e == "hang": time.sleep(60)
+        if e == "crash": sys.exit(1)
+        print(json.dumps({"id": req["id"], "i": i, "ast": [], "value": {"t": 0, "v": len(e)}}), flush=True)
+"""
+
+def oracle_tests():
+    with Oracle([sys.executable, "-c", STUB], timeout=0.5) as o:
+        values = lambda rs: [r["value"]["v"] if "value" in r else type(r["error"]).__name__ for r in rs]
+        assert values(o.batch(["1", "22", "333"])) == [1, 2, 3]
+        assert values(o.batch(["1", "hang", "22"])) == [1, "OracleTimeout", 2]
+        assert values(o.batch(["crash", "1"])) == ["str", 1]
+        assert o.restarts == 2
+        assert values(o.batch(["x"*i for i in range(1000)])) == list(range(1000))
+    print("oracle tests passed")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--stub"]: oracle_tests()
+    else: tests()
\ No newline at end of file
@@ -0,0 +1,254 @@
+# Compile k node trees into trees of Python closures.
+#
+# k.eval re-dispatches on the node type every time it visits a node. Here each node is instead
+# turned into a closure once, with its verb implementation and children already bound, so running
+# the compiled code is just a chain of Python calls. k.eval stays around as the reference.
+
+import sys, time
+import k, parse, optimize
+from k import is_, Num, Char, Vec, Str, List, DyadApply, MonadApply, AdverbMonadApply, Function, Var, Verb, Assign, Const, Fused, Depend, Delay, Force
+
+class Scope:
+    """The variables of a Function, resolved to fixed slots of its frames.
+
+    A frame is a Python list allocated once per call: frame[0] is the frame the Function was
+    created in (None at the top level) and frame[1:] holds the arguments, then the locals. A
+    local is an argument or any name assigned in the body. Other names resolve lexically to an
+    enclosing Function's slot, or failing that to a global, and so does a local read before it
+    is assigned, as in {a: a+1}."""
+    def __init__(self, fn, parent):
+        self.parent = parent
+        self.slots = {}
+        for name in fn.args + assigned(fn.body):
+            self.slots.setdefault(name, len(self.slots) + 1)
+
+    def resolve(self, name):
+        "Returns (depth, slot) for name, or None if it is a global."
+        scope, depth = self, 0
+        while scope is not None:
+            if name in scope.slots: return depth, scope.slots[name]
+            scope, depth = scope.parent, depth + 1
+        return None
+
+def assigned(body):
+    "Returns the names assigned in body, in order, not looking inside nested Functions."
+    names, todo = [], list(reversed(body))
+    while todo:
+        expr = todo.pop()
+        if is_(expr, Assign) and expr.name not in names: names.append(expr.name)
+        if not is_(expr, Function): todo.extend(reversed(k.children(expr)))
+    return names
+
+class Template:
+    "The compiled code of a Function, shared by every Lambda created from it."
+    def __init__(self, fn, scope):
+        self.fn = fn
+        self.scope = Scope(fn, scope)
+        self.nargs = len(fn.args)
+        self.nlocals = len(self.scope.slots) - self.nargs
+        self.code = [compile(expr, self.scope) for expr in fn.body]
+
+class Lambda(Function):
+    "A compiled Function closed over the frame it was created in. It is still a Function, but is called directly."
+    def __init__(self, template, parent):
+        Function.__init__(self, template.fn.args, template.fn.body)
+        self.template = template
+        self.parent = parent
+
+    def __call__(self, *args): return k.apply_fn(self, args)
+
+    def call(self, args):
+        "Runs the body on args. apply_fn has checked their number."
+        t = self.template
+        frame = [self.parent, *args]
+        if t.nlocals: frame.extend([None] * t.nlocals)
+        r = None
+        for code in t.code:
+            r = code(frame)
+        return r
+
+    def resolve(self, name):
+        "The value of the name, which the body uses but doesn't bind, in the frames this closes over or else the globals."
+        scope = self.template.scope.parent
+        where = scope.resolve(name) if scope else None
+        if where is None: return k.global_value(name)
+        frame = self.parent
+        for _ in range(where[0]): frame = frame[0]
+        return frame[where[1]]
+
+    def __eq__(self, other): return is_(other, Function) and self.args == other.args and self.body == other.body
+    def __hash__(self): return hash(self.template.fn) # the same as the Function's
+    def __repr__(self): return "<Lambda: args=%r body=%r>" % (self.args, self.body)
+
+def unbound(name):
+    raise k.BindingError("Unbound variable '%s'" % name)
+
+def compile_var(name, scope):
+    where = scope.resolve(name) if scope else None
+    if where is None: # global
+        def var(frame):
+            v = k.global_value(name)
+            return unbound(name) if v is None else v
+        return var
+    depth, slot = where
+    owner = scope
+    for _ in range(depth): owner = owner.parent
+    outer = compile_var(name, owner.parent) # until the slot is assigned
+    if depth == 0: # local
+        def var(frame):
+            v = frame[slot]
+            return outer(frame[0]) if v is None else v
+    else: # in an enclosing Function
+        def var(frame):
+            for _ in range(depth): frame = frame[0]
+            v = frame[slot]
+            return outer(frame[0]) if v is None else v
+    return var
+
+def compile_assign(name, v, scope):
+    where = scope.resolve(name) if scope else None
+    if where is None:
+        def assign(frame):
+            return k.bind_global(name, v(frame))
+    else: # always a local, since assigned names are locals
+        slot = where[1]
+        def assign(frame):
+            x = frame[slot] = v(frame)
+            return x
+    return assign
+
+def compile_fn(fn, scope):
+    "Compiles a Function into a closure creating a Lambda over the current frame."
+    t = Template(fn, scope)
+    return lambda frame: Lambda(t, frame)
+
+def compile_op(op, scope):
+    "Compiles the op of an apply node into a closure returning a Lambda (or a Function variable), or a verb name."
+    if is_(op, Function): return compile_fn(op, scope), None
+    if is_(op, Var): return compile_var(op.name, scope), None # like f' x
+    return None, k.verb_name(op)
+
+def compile(expr, scope=None):
+    "Compiles expr into a closure that takes a frame (None at the top level) and returns the value of expr."
+    if is_(expr, Num) or is_(expr, Char) or is_(expr, Vec) or is_(expr, Str) or is_(expr, Verb):
+        return lambda frame: expr
+    if is_(expr, Const):
+        v = expr.v
+        return lambda frame: v
+    if is_(expr, Function):
+        return compile_fn(expr, scope)
+    if is_(expr, Fused):
+        args = [compile(a, scope) for a in expr.args]
+        return lambda frame: k.apply_fused(expr, [a(frame) for a in args])
+    if is_(expr, Delay):
+        code = compile(expr.v, scope)
+        return lambda frame: k.Thunk(lambda: code(frame))
+    if is_(expr, Force):
+        v = compile(expr.v, scope)
+        return lambda frame: k.force(v(frame))
+    if is_(expr, Depend): # views are globals, and so is what they use
+        name, v, code = expr.name, expr.v, compile(expr.v)
+        return lambda frame: k.define(name, v, lambda: code(None))
+    if is_(expr, List):
+        items = [compile(e, scope) for e in expr.v]
+        return lambda frame: k.pack([item(frame) for item in items])
+    if is_(expr, DyadApply):
+        l, r = compile(expr.l, scope), compile(expr.r, scope)
+        fn, name = compile_op(expr.op, scope)
+        if fn: return lambda frame: fn(frame)(l(frame), r(frame))
+        f = k.dyads[name]
+        def dyad(frame):
+            profiler = k.current().profiler
+            if profiler is None: return f(l(frame), r(frame))
+            x, y = l(frame), r(frame)
+            return profiler.call(name, k.count(x) + k.count(y), f, x, y)
+        return dyad
+    if is_(expr, MonadApply):
+        v = compile(expr.v, scope)
+        fn, name = compile_op(expr.op, scope)
+        if fn: return lambda frame: fn(frame)(v(frame))
+        f, key = k.monads[name], name + ":"
+        def monad(frame):
+            profiler = k.current().profiler
+            if profiler is None: return f(v(frame))
+            x = v(frame)
+            return profiler.call(key, k.count(x), f, x)
+        return monad
+    if is_(expr, AdverbMonadApply):
+        adv, v = expr.adv, compile(expr.v, scope)
+        fn, _ = compile_op(expr.op, scope)
+        if fn: return lambda frame: k.apply_adverb(adv, fn(frame), v(frame))
+        op = expr.op
+        return lambda frame: k.apply_adverb(adv, op, v(frame))
+    if is_(expr, Var):
+        return compile_var(expr.name, scope)
+    if is_(expr, Assign):
+        assign = compile_assign(expr.name, compile(expr.v, scope), scope)
+        if k.is_append(expr): return lambda frame: k.appending(lambda: assign(frame))
+        return assign
+    raise k.InternalError("compile: unhandled expr: " + repr(expr))
+
+def eval(expr):
+    "Optimizes (unless optimize.enabled is False), compiles and runs expr."
+    if optimize.enabled: expr = optimize.optimize(expr)
+    return compile(expr)(None)
+
+def run(src):
+    "Optimizes (unless optimize.enabled is False), compiles and runs the K script src, returning the value of its last statement."
+    exprs = parse.parse(src)
+    if optimize.enabled: exprs = list(map(optimize.optimize, exprs))
+    r = None
+    for code in [compile(expr) for expr in exprs]:
+        r = code(None)
+    return r
+
+def tests():
+    failed = 0
+    for src in ["1+2", "1 2 3*4 5 6", "-1 2", "#!5", "{x*2}' 1 2 3", "-:' 1 2 3", "{x+y}[42; 8]",
+                "{{x+y}[x; y]}[42; 8]", "{{x*{x*5}2}x*4}5", "{x*y}/ 1 2 3", "{x+y}\\ 1 2 3", "+\\ 1 2 3",
+                "*/1+!10", "{1_x}\\ 1 2 3", "{{1_x}\\x} 4 5", "2 3 # 1 2", "a: 1; b: 2; a+b",
+                "(1 2)[1 0]", "{x[(#x)-1]} 2 5 1 3", "{a: x+1; a*2} 3", "a: 10; {x+a} 1",
+                "{f: {x*2}; f x} 5", "{y; {x+y}[x; 2]}[1; 3]", "{{x}x*4; x}5", "a: 10; {a: a+1; a} 0", "{b: 1; {b: b*2; b} 0} 0",
+                "a: 2; b:: a*3; b+{x+b} 1", "g: 1; f: {x+g}; t:: f 1; t; g: 100; t", "v: 1 2 3; t:: +/v; u:: t*2; u; v: v, 4 5; u"]: # the env of the last one is checked below
+        k.default.reset()
+        expected = [k.eval(e) for e in parse.parse(src)][-1]
+        k.default.reset()
+        got = run(src)
+        if got != expected:
+            print("FAIL: Got %r, expected %r for: %s" % (got, expected, src))
+            failed += 1
+    if k.view_stats()["t"] != {"hits": 3, "recomputes": 1, "increments": 1}:
+        print("FAIL: compiled appends aren't folded into views: %r" % k.view_stats())
+        failed += 1
+    memo = k.memoize(parse.parse("{x*2}")[0])
+    if run("{x*2}' 1 2 1 1") != k.to_k([2, 4, 2, 2]) or memo.stats()["hits"] != 2:
+        print("FAIL: compiled Lambdas aren't memoized")
+        failed += 1
+    k.memoize(parse.parse("{x+a}")[0])
+    if run("a: 1; {x+a} 1") != k.Num(2) or run("a: 100; {x+a} 1") != k.Num(101) or run("{a: 5; {x+a} 1} 0") != k.Num(6):
+        print("FAIL: compiled Lambdas are memoized by their arguments only")
+        failed += 1
+    k.default.memos.clear()
+    with k.profiling() as p: run("{x*2}' !4")
+    if p.stats["*"][0] != 4 or p.stats["!:"][0] != 1 or p.stats["{lambda}@1:1'"][0] != 1:
+        print("FAIL: compiled code isn't profiled: %r" % p.stats)
+        failed += 1
+    print("compiler tests: %d failed" % failed)
+
+def bench(n=2000, repeat=3):
+    "Times the reference interpreter against compiled code on adverb-heavy loops."
+    for src in ["{x*y}/ %d#1" % n, "{{x+1}x}' !%d" % n, "{x+y}\\ !%d" % n, "{x*2}' !%d" % n, "{1_x}\\ !%d" % (n // 4)]:
+        expr = parse.parse(src)[0]
+        times = []
+        for ev in (k.eval, lambda e, code=compile(expr): code(None)):
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                ev(expr)
+                best = min(best, time.perf_counter() - start)
+            times.append(best)
+        print("%-16s  eval %8.2fms  compiled %8.2fms  %.1fx" % (src, times[0]*1e3, times[1]*1e3, times[0]/times[1]))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]: bench()
+    else: tests()
@@ -1,48 +1,325 @@
-import operator, math, collections
-
-def node(name, props):
-    def set_props(self, *propvs):
-        for prop, value in zip(props.split(), propvs):
-            setattr(self, prop, value)
-    return type(name, (Node,), {"__init__": set_props,
-                                "__repr__": lambda self: "<%s: %s>" % (name, " ".join("%s=%r" % (k,v) for k,v in self.__dict__.items())),
-                                "__eq__": lambda self, other: self.__class__.__name__ == other.__class__.__name__ and self.__dict__ == other.__dict__
-                                })
-
-class Node: pass
+import operator, math, collections, itertools, time, contextlib, types, threading, mmap, array
+
+try:
+    import numpy as np
+except ImportError: # vectors fall back to boxed Lists
+    np = None
+
+def freeze(v):
+    "A hashable stand-in for a node field: lists become tuples."
+    return tuple(map(freeze, v)) if type(v) is list else v
+
+def node_hash(self):
+    "A structural hash, computed once and cached. Nodes must not be modified after they are hashed."
+    try: return self._hash
+    except AttributeError:
+        self._hash = hash((self.__class__.__name__,) + tuple(freeze(getattr(self, f)) for f in self._fields))
+        return self._hash
+
+def node_state(self):
+    "Pickles the fields and cached metadata, but not the hash: string hashes differ between processes."
+    cls = type(self)
+    slots = {s: getattr(self, s) for s in self.__slots__ # skipping fields a subclass replaced with properties, like Vec.v
+             if s != "_hash" and type(getattr(cls, s)) is types.MemberDescriptorType and hasattr(self, s)}
+    return getattr(self, "__dict__", None), slots
+
+def node(name, props, cache=()):
+    """Makes a node class with the fields in props. Instances are slotted, so they carry no
+    __dict__, and compare and hash field by field. cache names extra slots for cached metadata."""
+    fields = tuple(props.split())
+    # __init__ and __eq__ are generated so that they don't loop over the fields at run time
+    ns = {"__slots__": fields + ("_hash",) + tuple(cache), "_fields": fields, "__hash__": node_hash, "__getstate__": node_state,
+          "__repr__": lambda self: "<%s: %s>" % (name, " ".join("%s=%r" % (k, getattr(self, k)) for k in fields))}
+    exec("def __init__(self, %s):\n    %s\n" % (", ".join(fields), "; ".join("self.%s = %s" % (f, f) for f in fields)), ns)
+    exec("def __eq__(self, other):\n    return self.__class__ is other.__class__ and %s\n" % " and ".join("self.%s == other.%s" % (f, f) for f in fields), ns)
+    return type(name, (Node,), ns)
+
+class Node: __slots__ = ()
 Num = node('Num', 'v')
 Char = node('Char', 'v')
-List = node('List', 'v')
+List = node('List', 'v', cache=('_shape', '_uniform', '_structure'))
 DyadApply = node('DyadApply', 'l op r')
 MonadApply = node('MonadApply', 'op v')
 AdverbMonadApply = node('AdverbMonadApply', 'adv op v')
 AdverbDyadApply = node('AdverbDyadApply', 'adv l op r')
-Function = node('Function', 'args body')
+Function = node('Function', 'args body', cache=('pos', 'name')) # where it was parsed and what it was assigned to, if known
 Var = node('Var', 'name')
 Verb = node('Verb', 'name forcemonad')
 Assign = node('Assign', 'name v')
+Const = node('Const', 'v') # a value the optimizer computed ahead of time, see optimize.py
+Fused = node('Fused', 'tree args') # a chain of elementwise verbs run in one pass, see run_fused
+Depend = node('Depend', 'name v') # the view name::v, see Dependent
+Delay = node('Delay', 'v') # a Thunk running v, see optimize.hoist
+Force = node('Force', 'v') # the value of v, or of the Thunk v is
+
+# Small ints and all chars are interned: Num(1) is Num(1). Nodes are never modified in place, so
+# sharing them is safe.
+_small_nums = {}
+_chars = {}
+
+def new_num(cls, v=None):
+    if type(v) is int and -256 <= v < 1024 and cls is Num:
+        n = _small_nums.get(v)
+        if n is None: n = _small_nums[v] = object.__new__(cls)
+        return n
+    return object.__new__(cls)
+
+def new_char(cls, v=None):
+    if cls is not Char or v is None: return object.__new__(cls)
+    c = _chars.get(v)
+    if c is None: c = _chars[v] = object.__new__(cls)
+    return c
+
+Num.__new__ = new_num
+Char.__new__ = new_char
+Num.__reduce__ = lambda self: (Num, (self.v,)) # so unpickling interns too
+Char.__reduce__ = lambda self: (Char, (self.v,))
 
 Num.__lt__ = lambda self, other: self.v < other.v
 Char.__lt__ = lambda self, other: self.v < other.v
 
+def node_memory(n=100000):
+    "Measures the memory taken by a boxed List of n Nums and by a string of n Chars, with tracemalloc."
+    import tracemalloc
+    tracemalloc.start()
+    for label, make in [("%d boxed Nums" % n, lambda: List([Num(i) for i in range(n)])),
+                        ("%d boxed small Nums" % n, lambda: List([Num(i % 100) for i in range(n)])),
+                        ("%d Chars" % n, lambda: List([Char(97 + i % 26) for i in range(n)])),
+                        ("a Str of %d chars" % n, lambda: Str("".join(chr(97 + i % 26) for i in range(n))))]:
+        before = tracemalloc.get_traced_memory()[0]
+        x = make()
+        print("%-22s %6.1f bytes/item" % (label, (tracemalloc.get_traced_memory()[0] - before) / n))
+        del x
+    tracemalloc.stop()
+
+class Vec(List):
+    "A homogeneous int or float vector backed by a contiguous NumPy array. Behaves like a List of Nums."
+    def __init__(self, a): self.a = a
+    @property
+    def v(self): return list(map(Num, self.a.tolist())) # boxed view, built on demand
+    def __repr__(self): return "<Vec: a=%r>" % self.a.tolist()
+
+class Range(Vec):
+    """The arithmetic progression start, start+step, ... of n items, as made by !n. Scalar
+    arithmetic, take, drop, count and the +/ and */ reductions keep it lazy. Anything else
+    treats it as a Vec, and the array is only built then."""
+    def __init__(self, start, step, n):
+        self.start, self.step, self.n = start, step, n
+        self._a = None
+    @property
+    def a(self):
+        if self._a is None:
+            self._a = np.arange(self.n, dtype=np.int64 if self.is_int() else np.float64) * self.step + self.start
+        return self._a
+    @property
+    def v(self): return list(map(Num, self.values()))
+    def is_int(self): return type(self.start) is int and type(self.step) is int
+    def values(self):
+        "Iterates over the items as Python numbers without building the array."
+        if self.is_int() and self.step != 0: return range(self.start, self.start + self.step*self.n, self.step)
+        return (self.start + i*self.step for i in range(self.n))
+    def __repr__(self): return "<Range: start=%r step=%r n=%r>" % (self.start, self.step, self.n)
+
+def list_eq(self, other):
+    if not is_(other, List): return False
+    if is_(self, Range) and is_(other, Range) and (self.start, self.step, self.n) == (other.start, other.step, other.n):
+        return True
+    if is_(self, Vec) and is_(other, Vec):
+        return self.a.shape == other.a.shape and bool((self.a == other.a).all())
+    if is_(self, Str) and is_(other, Str): return self.s == other.s
+    if is_(self, Array) and is_(other, Array) and type(self.buf) is not list and type(other.buf) is not list:
+        if self.shape != other.shape: return False
+        if type(self.buf) is str or type(other.buf) is str: return self.flat() == other.flat()
+        return bool((self.flat() == other.flat()).all())
+    return self.v == other.v
+
+def list_hash(self):
+    "Hashes like a List of the same items, since lists compare equal whatever their representation."
+    try: return self._hash
+    except AttributeError:
+        if is_(self, Vec): items = tuple(hash(("Num", v)) for v in (self.values() if is_(self, Range) else self.a.tolist()))
+        elif is_(self, Str): items = tuple(hash(("Char", c)) for c in map(ord, self.s))
+        else: items = tuple(map(hash, self.v))
+        self._hash = hash(("List", items))
+        return self._hash
+
+List.__eq__ = list_eq
+List.__hash__ = list_hash
+Vec.__eq__ = list_eq
+Range.__eq__ = list_eq
+
+class View(List):
+    """A List whose items are base[i] for i in idx, where base is the Python list of the List it
+    was taken from. idx is a range for slices (offset, length and stride) or a list of ints for
+    gathers, so taking a view never copies the items. Reading v returns a copy of the items, and
+    assigning v gives the view its own storage (copy on write)."""
+    def __init__(self, base, idx): self.base, self.idx = base, idx
+    @property
+    def v(self):
+        idx = self.idx
+        if type(idx) is range and idx.step == 1: return self.base[idx.start:idx.stop]
+        return [self.base[i] for i in idx]
+    @v.setter
+    def v(self, items): self.base, self.idx = items, range(len(items))
+    def __repr__(self): return "<View: v=%r>" % self.v
+
+View.__eq__ = list_eq
+
+class Array(List):
+    """A rectangular list with the given shape (of rank 2 or more) whose atoms are stored flat, in
+    row-major order, in buf from offset on. buf is a NumPy array, a str of chars or a Python list
+    of k values. Rows are made when v is read, as Arrays, Vecs, Strs or Views over the same buffer."""
+    def __init__(self, buf, shape, offset=0): self.buf, self.shape, self.offset = buf, shape, offset
+    @property
+    def v(self):
+        n, rest = self.shape[0], self.shape[1:]
+        size = product(rest)
+        if len(rest) > 1: return [Array(self.buf, rest, self.offset + i*size) for i in range(n)]
+        if type(self.buf) is list: return [View(self.buf, range(self.offset + i*size, self.offset + (i+1)*size)) for i in range(n)]
+        if type(self.buf) is str: return [Str(self.buf[self.offset + i*size:self.offset + (i+1)*size]) for i in range(n)]
+        return [Vec(self.buf[self.offset + i*size:self.offset + (i+1)*size]) for i in range(n)]
+    def flat(self): return self.buf[self.offset:self.offset + product(self.shape)]
+    def __repr__(self): return "<Array: shape=%r v=%r>" % (self.shape, self.v)
+
+Array.__eq__ = list_eq
+
+class Buf(List):
+    """A vector of Nums, or of Chars if chars is set, over the one-dimensional memoryview m of some
+    buffer, like a memory-mapped file. Nothing is copied or boxed until v is read, and slicing it
+    slices m."""
+    def __init__(self, m, chars=False): self.m, self.chars = m, chars
+    @property
+    def v(self): return list(map(Char if self.chars else Num, self.m.tolist()))
+    def __reduce__(self): # memoryviews don't pickle, so send a copy
+        return buf_from_bytes, (self.m.tobytes(), self.m.format, self.chars)
+    def __repr__(self): return "<Buf: format=%r chars=%r v=%r>" % (self.m.format, self.chars, self.m.tolist())
+
+def buf_from_bytes(data, format, chars): return Buf(memoryview(data).cast(format), chars)
+
+class Lines(List):
+    """The lines of the text in the memoryview m, as Bufs of Chars made when they are asked for.
+    starts holds the offset of each line and, last, the end of the text."""
+    def __init__(self, m, starts): self.m, self.starts = memoryview(m), starts
+    @property
+    def v(self): return [line(self, i) for i in range(len(self.starts) - 1)]
+    def __reduce__(self): return Lines, (self.m.tobytes(), self.starts)
+    def __repr__(self): return "<Lines: n=%d>" % (len(self.starts) - 1)
+
+def line(x, i):
+    "The i'th line of the Lines x, without its line ending."
+    lo, hi = x.starts[i], x.starts[i+1]
+    if hi > lo and x.m[hi-1] == 10: hi -= 1
+    if hi > lo and x.m[hi-1] == 13: hi -= 1
+    return Buf(x.m[lo:hi], chars=True)
+
+class Str(List):
+    """A string: a list of Chars held as the Python str s, which takes a byte or so per char. Chars
+    are only made when v is read or an item is taken out."""
+    def __init__(self, s): self.s = s
+    @property
+    def v(self): return [Char(ord(c)) for c in self.s]
+    def __repr__(self): return "<Str: s=%r>" % self.s
+
+Buf.__eq__ = list_eq
+Lines.__eq__ = list_eq
+Str.__eq__ = list_eq
+
 is_ = isinstance
 
-def newEnv(): return [{}]
-def pushScope(): env.insert(0, {})
-def popScope(): env.pop(0)
+def children(expr):
+    "Returns the nodes directly under expr, including the statements of a Function body."
+    if is_(expr, DyadApply): xs = [expr.l, expr.op, expr.r]
+    elif is_(expr, MonadApply): xs = [expr.op, expr.v]
+    elif is_(expr, AdverbMonadApply): xs = [expr.op, expr.v]
+    elif is_(expr, AdverbDyadApply): xs = [expr.l, expr.op, expr.r]
+    elif is_(expr, Function): xs = expr.body
+    elif is_(expr, Assign) or is_(expr, Depend) or is_(expr, Delay) or is_(expr, Force): xs = [expr.v]
+    elif is_(expr, Fused): xs = expr.args
+    elif is_(expr, List) and type(expr) is List: xs = expr.v
+    else: xs = []
+    return [x for x in xs if is_(x, Node)]
+
+# env is a stack of scopes, with the globals at the bottom (env[0]) and the innermost scope at the top.
+# Each Interpreter has its own; a thread evaluates in default's unless it is in another one's call.
+# A global can be a view (a Dependent), whose value is computed when it is looked up.
+class Env(list):
+    "A stack of scopes. watch maps a global name to the views aggregating it, see Dependent."
+    def __init__(self):
+        list.__init__(self, [{}])
+        self.watch = {}
+
+def newEnv(): return Env()
+def pushScope(): scopes().append({})
+def popScope(): scopes().pop()
 def bind(name, v):
-    for e in env:
+    env = scopes()
+    for e in reversed(env):
         if name in e:
+            if e is env[0]: return bind_global(name, v)
             e[name] = v
-            return
+            return v
+    env[-1][name] = v
+    return v
+def bind_global(name, v):
+    env = scopes()
+    if env.watch or type(env[0].get(name)) is Dependent: rebinding(env, name, v)
     env[0][name] = v
     return v
 def lookup(name):
-    for e in env:
-        if name in e: return e[name]
+    for e in reversed(scopes()):
+        if name in e:
+            v = e[name]
+            return v.value() if type(v) is Dependent else v
     return None
+def global_value(name):
+    "The value of the global name, or None. A view is computed if it has to be."
+    v = scopes()[0].get(name)
+    return v.value() if type(v) is Dependent else v
+
+class Interpreter:
+    """An evaluation context owning its own env, memoized Functions, profiler and converge settings,
+    so separate Interpreters don't see each other's and can evaluate at the same time in different
+    threads. Calls nest: eval on one Interpreter from inside another's returns to the outer one
+    afterwards."""
+    def __init__(self):
+        self.env = newEnv()
+        self.memos = {} # Function -> Memo
+        self.profiler = None
+        self.converge_limit = None # raise GeneralError if a converge takes more steps than this
+        self.converge_info = {"iterations": 0, "cycle": 0} # about the last converge
+        self.tests_succeeded = self.tests_failed = 0 # counted by teq and terr
+
+    def eval(self, expr): return self.call(eval, expr)
+
+    def call(self, f, *args):
+        "Calls the Python function f with this Interpreter as the current one."
+        outer = _current.interp
+        _current.interp = self
+        try: return f(*args)
+        finally: _current.interp = outer
+
+    def run(self, exprs):
+        "Evaluates a list of statements, returning the value of the last one."
+        r = None
+        for expr in exprs: r = self.eval(expr)
+        return r
+
+    def reset(self): self.env = newEnv()
+
+default = Interpreter() # the one code outside any other Interpreter's call evaluates in
+
+class Current(threading.local):
+    interp = default # the Interpreter this thread is evaluating in
+    joining = False # in an append v: v, y, see appending
+    joined = None # the last join of an append and its operands, see rebinding
 
-env = newEnv()
+_current = Current()
+
+def current(): return _current.interp
+
+def scopes():
+    "The env this thread evaluates in."
+    return _current.interp.env
 
 def is_atom(x): return not is_(x, List)
 
@@ -52,16 +329,94 @@ class TypeError(Exception): pass
 class LengthError(Exception): pass
 class BindingError(Exception): pass
 
+def pack(xs):
+    "Packs a Python list of k values into a Str if they are all Chars, a Vec if they are all ints or all floats, otherwise into a List."
+    if xs and all(is_(x, Char) for x in xs): return Str("".join([chr(x.v) for x in xs]))
+    if np is None or not xs or not all(is_(x, Num) for x in xs): return List(xs)
+    vs = [x.v for x in xs]
+    if all(type(v) is int for v in vs): dtype = np.int64
+    elif all(type(v) is float for v in vs): dtype = np.float64
+    else: return List(xs) # mixed, so that the ints stay ints
+    try: return Vec(np.array(vs, dtype=dtype))
+    except OverflowError: return List(xs) # bigger than int64, keep it boxed
+
+def int_vector(vs):
+    "Makes a vector of the Python ints vs without boxing them: a Vec, or a Buf over an array.array without NumPy."
+    if np is not None: return Vec(np.array(vs, dtype=np.int64))
+    return Buf(memoryview(array.array("q", vs)))
+
 def to_k(v):
     if isinstance(v, int) or isinstance(v, float): return Num(v)
-    if isinstance(v, list): return List(list(map(to_k, v)))
-    raise InternalError("to_k: unhandled value " + repr(v))
+    if isinstance(v, list): return pack(list(map(to_k, v)))
+    try: m = memoryview(v)
+    except Exception: raise InternalError("to_k: unhandled value " + repr(v))
+    return from_buffer(m)
 
 def from_k(v):
     if is_(v, Num): return v.v
+    if is_(v, Vec): return v.a.tolist()
+    if is_(v, Buf) and not v.chars: return v.m.tolist()
+    if is_(v, Array) and type(v.buf) not in (list, str): return v.flat().reshape(v.shape).tolist()
     if is_(v, List): return list(map(from_k, v.v))
     raise InternalError("from_k: unhandled value " + repr(v))
 
+# Buffers. to_k wraps anything with the buffer protocol (bytes, bytearray, array.array,
+# memoryview, NumPy arrays...) as a k value without copying it, and as_buffer hands a k vector
+# back as a read-only memoryview, only copying if it is boxed. A wrapped buffer is shared, not
+# owned: k never writes to it, but a host that changes it afterwards changes every k value over
+# it, so wrap it with from_buffer(obj, copy=True) if it will change. Wrapped numbers keep the
+# buffer's item type, which as_buffer hands back, but arithmetic on them works in 64 bits (see
+# wide), so it doesn't wrap at the buffer's width.
+
+NUMBER_FORMATS = set("bBhHiIlLqQnNfd")
+
+def typed(data, fmt, shape):
+    "A memoryview of the bytes data as items of format fmt with the given shape, or flat if it is empty."
+    m = memoryview(data)
+    return m.cast(fmt, shape) if product(shape) else m.cast(fmt) # cast refuses zeros in the shape
+
+def from_buffer(obj, copy=False):
+    """Wraps the buffer obj as a k value: a string for bytes, bytearray and format 'c', otherwise
+    numbers. One-dimensional buffers become a Vec, or a Buf without NumPy. Buffers of more
+    dimensions become an Array if there is NumPy and they are contiguous, and are copied otherwise."""
+    m = memoryview(obj)
+    if copy: m = typed(m.tobytes(), m.format, m.shape)
+    fmt = m.format.lstrip("@")
+    if fmt == "c" or type(m.obj) in (bytes, bytearray) and fmt == "B":
+        if m.ndim != 1: raise TypeError(obj)
+        return Buf(m if fmt == "B" else m.cast("B"), chars=True)
+    if fmt not in NUMBER_FORMATS: raise TypeError(obj)
+    if m.ndim == 0: return Num(m[()])
+    if np is not None:
+        a = np.asarray(m) # a view of the same memory
+        if a.ndim == 1: return Vec(a)
+        if a.flags.c_contiguous: return Array(a.reshape(-1), a.shape)
+    elif m.ndim == 1: return Buf(m)
+    return to_k(m.tolist())
+
+def atoms(x):
+    "The atoms of x, in row-major order."
+    if not is_(x, List): return [x]
+    return [a for v in x.v for a in atoms(v)]
+
+def as_buffer(x):
+    """Returns the k list x, which must be rectangular and all numbers or all chars, as a read-only
+    memoryview of the right shape. Strings have format 'c', ints 'q' and floats 'd' unless x came
+    from a buffer with some other type. Vecs, Bufs and Arrays of NumPy arrays aren't copied."""
+    if is_(x, Buf): return (x.m.cast("c") if x.chars else x.m).toreadonly()
+    if is_(x, Vec): return memoryview(x.a).toreadonly()
+    if is_(x, Array) and type(x.buf) not in (list, str): return memoryview(x.flat().reshape(x.shape)).toreadonly()
+    if not is_(x, List) or not is_uniform(x): raise TypeError(x)
+    shape, items = shape_of(x), atoms(x)
+    if all(is_(c, Char) for c in items): fmt, data = "c", bytes(c.v for c in items)
+    elif all(is_(n, Num) for n in items):
+        vs = [n.v for n in items]
+        fmt = "q" if all(type(v) is int for v in vs) else "d"
+        try: data = array.array(fmt, vs).tobytes()
+        except OverflowError: raise TypeError(x) # bigger than int64
+    else: raise TypeError(x)
+    return typed(data, fmt, shape).toreadonly()
+
 def to_dyad(f):
     "Lifts a binary Python function into a boxed dyadic function"
     return lambda x,y: to_k(f(from_k(x), from_k(y)))
@@ -71,8 +426,65 @@ def nums(*args): return list(map(Num, args))
 def recursive_shape(v):
     "A helper function for returning the shape of possibly nested lists, for the purpose of comparing list shapes."
     if not is_(v, List): return 0
+    if is_(v, Vec) or is_(v, Buf) or is_(v, Str): return [0]*count(v)
     return list(map(recursive_shape, v.v))
 
+# Shape metadata. Lists are never modified once they have been built, so the shape of a List
+# is computed the first time it is asked for and cached on it (and on all of its sublists).
+
+def count(x):
+    "The number of items in x, or 1 for an atom."
+    if is_(x, Range): return x.n
+    if is_(x, Array): return x.shape[0]
+    if is_(x, View): return len(x.idx)
+    if is_(x, Vec): return len(x.a)
+    if is_(x, Buf): return len(x.m)
+    if is_(x, Str): return len(x.s)
+    if is_(x, Lines): return len(x.starts) - 1
+    if is_(x, List): return len(x.v)
+    return 1
+
+def shape_of(x):
+    """Returns the shape of x as a tuple, like NumPy's: () for an atom, and (n,) + s for a list of
+    n items that all have shape s. A ragged list only gets (n,), see is_uniform."""
+    if not is_(x, List): return ()
+    if is_(x, Vec) or is_(x, Buf) or is_(x, Str): return (count(x),)
+    if is_(x, Array): return x.shape
+    try: return x._shape
+    except AttributeError: pass
+    items = x.v
+    shapes = [shape_of(v) for v in items]
+    uniform = all(s == shapes[0] and is_uniform(v) for s, v in zip(shapes, items))
+    x._shape = (len(items),) + (shapes[0] if items and uniform else ())
+    x._uniform = uniform
+    return x._shape
+
+def is_uniform(x):
+    "Is x an atom, or a list whose items all have the same shape at every depth?"
+    if not is_(x, List) or is_(x, Vec) or is_(x, Array) or is_(x, Buf) or is_(x, Str): return True
+    try: return x._uniform
+    except AttributeError:
+        shape_of(x)
+        return x._uniform
+
+def rank_of(x):
+    "The number of dimensions of x, counting only the uniform ones of a ragged list."
+    return len(shape_of(x))
+
+def structure(x):
+    "recursive_shape as nested tuples, cached, for comparing ragged lists."
+    if not is_(x, List): return 0
+    if is_(x, Vec) or is_(x, Buf) or is_(x, Str): return (0,) * count(x)
+    try: return x._structure
+    except AttributeError:
+        x._structure = tuple(map(structure, x.v))
+        return x._structure
+
+def conformable(x, y):
+    "Do lists x and y have the same recursive_shape? O(rank) unless both are ragged."
+    if shape_of(x) != shape_of(y) or is_uniform(x) != is_uniform(y): return False
+    return is_uniform(x) or structure(x) == structure(y)
+
 def zip_with(f, xs, ys):
     return [f(x, y) for x, y in zip(xs, ys)]
 
@@ -83,8 +495,11 @@ def product(xs):
 
 def elementwise(f, x, y):
     if is_(x, List) and is_(y, List):
-        if recursive_shape(x) == recursive_shape(y): return List(zip_with(f, x.v, y.v))
+        if conformable(x, y): return List(zip_with(f, x.v, y.v))
         else: raise LengthError(x, y)
+    # extend an atom over a list
+    if is_(x, List) and is_(y, Num): return List([f(v, y) for v in x.v])
+    if is_(x, Num) and is_(y, List): return List([f(x, v) for v in y.v])
     raise TypeError(x, y)
 
 def fold(f, xs, v):
@@ -100,64 +515,217 @@ def scan(f, xs, v):
         r.append(v)
     return List(r)
 
+# Views. Take, drop, first and indexing work on the storage of a List in place of copying it.
+
+def storage(x):
+    "Returns (base, idx) such that the items of the boxed List x are base[i] for i in idx."
+    if is_(x, View): return x.base, x.idx
+    return x.v, range(len(x.v))
+
+def item(x, i):
+    "Returns the i'th item of x without copying or boxing the rest of it."
+    if type(i) is not int: raise TypeError(i)
+    if is_(x, Range):
+        if not -x.n <= i < x.n: raise IndexError(i)
+        return Num(x.start + (i % x.n)*x.step)
+    if is_(x, Vec): return Num(x.a[i].item())
+    if is_(x, View): return x.base[x.idx[i]]
+    if is_(x, Buf): return (Char if x.chars else Num)(x.m[i])
+    if is_(x, Lines): return line(x, range(count(x))[i])
+    if is_(x, Str): return Char(ord(x.s[i]))
+    return x.v[i]
+
+def as_range(r):
+    "Returns the Python range for the int Range r, or None."
+    if not r.is_int() or r.step == 0: return None
+    return range(r.start, r.start + r.step*r.n, r.step)
+
+def compose(idx, r):
+    "Indexes the storage indices idx with the range r, keeping a range when idx is one."
+    if len(r) and not (-len(idx) <= min(r[0], r[-1]) and max(r[0], r[-1]) < len(idx)): raise IndexError(r)
+    if type(idx) is range and (not len(r) or min(r[0], r[-1]) >= 0):
+        return range(idx.start + idx.step*r.start, idx.start + idx.step*r.stop, idx.step*r.step)
+    return [idx[i] for i in r]
+
+def take_view(x, n): # n#x for -#x <= n <= #x, the last -n items if n is negative
+    if type(n) is not int: raise TypeError(n)
+    if n < 0: return drop_view(x, count(x) + n)
+    if is_(x, Range): return Range(x.start, x.step, n)
+    if is_(x, Vec): return Vec(x.a[:n])
+    if is_(x, Buf): return Buf(x.m[:n], x.chars)
+    if is_(x, Str): return Str(x.s[:n])
+    base, idx = storage(x)
+    return View(base, idx[:n])
+
+def drop_view(x, n): # n_x, dropping the last -n items if n is negative
+    if type(n) is not int: raise TypeError(n)
+    if n < 0: return take_view(x, max(count(x) + n, 0))
+    if is_(x, Range):
+        n = min(n, x.n)
+        return Range(x.start + n*x.step, x.step, x.n - n)
+    if is_(x, Vec): return Vec(x.a[n:])
+    if is_(x, Buf): return Buf(x.m[n:], x.chars)
+    if is_(x, Str): return Str(x.s[n:])
+    base, idx = storage(x)
+    return View(base, idx[n:])
+
+def int_indices(indices):
+    "The items of indices as Python ints, raising TypeError unless they all are."
+    vs = from_k(indices)
+    if not all(type(i) is int for i in vs): raise TypeError(indices)
+    return vs
+
+def gather(x, indices): # x[indices]
+    r = as_range(indices) if is_(indices, Range) else None
+    if is_(x, Vec):
+        if r is not None and len(r) and min(r[0], r[-1]) >= 0 and max(r[0], r[-1]) < count(x):
+            return Vec(x.a[r.start:r.stop if r.stop >= 0 else None:r.step]) # a NumPy view
+        idx = indices.a if is_(indices, Vec) else np.asarray(int_indices(indices), dtype=np.int64)
+        if idx.size and idx.dtype.kind not in "iu": raise TypeError(indices) # NumPy would truncate floats
+        return Vec(x.a[idx])
+    if is_(x, Str):
+        s = x.s
+        if r is not None and len(r) and min(r[0], r[-1]) >= 0 and max(r[0], r[-1]) < len(s):
+            return Str(s[r.start:r.stop if r.stop >= 0 else None:r.step])
+        return Str("".join([s[i] for i in int_indices(indices)]))
+    base, idx = storage(x)
+    if r is not None: return View(base, compose(idx, r))
+    return View(base, [idx[i] for i in int_indices(indices)])
+
+# Arithmetic on arrays works in int64 and float64: arrays over files and buffers can have narrower
+# items, and are widened first. NumPy wraps around silently, while Python ints never overflow. So
+# before an int kernel runs, the bounds of its result are worked out from the least and greatest
+# items of its inputs, and if they don't fit in 64 bits it runs on Python ints instead. That
+# way a program gives the same answer with NumPy as without it.
+
+INT64_MIN, INT64_MAX = -2**63, 2**63 - 1
+
+def wide(a):
+    "The array a with int64 or float64 items, or None if it has uint64 items too big for int64."
+    t = a.dtype
+    if t == np.int64 or t == np.float64: return a
+    if t.kind == "f": return a.astype(np.float64)
+    if t == np.uint64 and a.size and int(a.max()) > INT64_MAX: return None
+    return a.astype(np.int64)
+
+def int_bounds(a):
+    "The least and greatest item of the int array or Python int a, or None if it is a float or float array."
+    if type(a) is int: return a, a
+    if type(a) is float or a.dtype.kind not in "iu": return None
+    if a.size == 0: return 0, 0
+    return int(a.min()), int(a.max())
+
+def bounds_after(f, bounds):
+    """The least and greatest result of f (+, - or * of two ints, or - of one) on ints within
+    bounds, or False if those or the results don't all fit in 64 bits."""
+    corners = [f(*c) for c in itertools.product(*bounds)] # f is linear in each argument
+    lo, hi = min(corners), max(corners)
+    ok = all(INT64_MIN <= b[0] and b[1] <= INT64_MAX for b in bounds) and INT64_MIN <= lo and hi <= INT64_MAX
+    return (lo, hi) if ok else False
+
+def wraps(f, *args):
+    "Could the kernel f, applied to the arrays and numbers args, wrap around at 64 bits?"
+    bounds = [int_bounds(a) for a in args]
+    return None not in bounds and bounds_after(f, bounds) is False
+
+def exact(f, *args):
+    "Applies f item by item to the arrays and numbers args as Python numbers, which don't wrap."
+    cols = [a.tolist() if isinstance(a, np.ndarray) else itertools.repeat(a) for a in args]
+    return pack(list(map(Num, map(f, *cols))))
+
+def range_arith(f, x, y):
+    """Applies +, - or * to a Range and a Num, or to two Ranges, giving a Range. Returns None for
+    anything else, and for a Range of ints that don't all fit in 64 bits."""
+    if is_(x, Range) and is_(y, Num):
+        if f is operator.mul: r = Range(x.start * y.v, x.step * y.v, x.n)
+        else: r = Range(f(x.start, y.v), x.step, x.n)
+    elif is_(x, Num) and is_(y, Range):
+        if f is not operator.sub: return range_arith(f, y, x)
+        r = Range(x.v - y.start, -y.step, y.n)
+    elif is_(x, Range) and is_(y, Range) and f is not operator.mul:
+        if x.n != y.n: raise LengthError(x, y)
+        r = Range(f(x.start, y.start), f(x.step, y.step), x.n)
+    else: return None
+    if r.is_int() and r.n and bounds_after(operator.pos, [sorted((r.start, r.start + r.step*(r.n - 1)))]) is False: return None
+    return r
+
+def vectorized(f, x, y):
+    "Applies the array kernel f if x and y are Vecs or a Vec and a Num, otherwise returns None."
+    if is_(x, Range) or is_(y, Range):
+        r = range_arith(f, x, y)
+        if r is not None: return r
+    if is_(x, Vec):
+        if is_(y, Vec) and count(x) != count(y): raise LengthError(x, y)
+        if not is_(y, Num) and not is_(y, Vec): return None
+    elif not is_(y, Vec) or not is_(x, Num): return None
+    args = [x.a if is_(x, Vec) else x.v, y.a if is_(y, Vec) else y.v]
+    wides = [wide(a) if isinstance(a, np.ndarray) else a for a in args]
+    if any(a is None for a in wides) or wraps(f, *wides): return exact(f, *args)
+    return Vec(f(*wides))
+
 def op_plus(x, y):
     if is_(x, Num) and is_(y, Num): return Num(x.v + y.v)
+    r = vectorized(operator.add, x, y)
+    if r is not None: return r
     if is_(x, Num) and is_(y, List): return List([Num(x.v + v.v) for v in y.v])
     return elementwise(op_plus, x, y)
 
 def op_minus(x, y):
     if is_(x, Num) and is_(y, Num): return Num(x.v - y.v)
+    r = vectorized(operator.sub, x, y)
+    if r is not None: return r
     if is_(x, Num) and is_(y, List): return List([Num(x.v - v.v) for v in y.v])
     return elementwise(op_minus, x, y)
 
 def op_star(x, y):
     if is_(x, Num) and is_(y, Num): return Num(x.v * y.v)
+    r = vectorized(operator.mul, x, y)
+    if r is not None: return r
     return elementwise(op_star, x, y)
 
-def repeat_list(x, n):
-    "If the list x is shorter than n, then repeat elements of x until its length is equal to n."
-    if len(x.v) < n:
-        # make enough copies needed to repeat enough times for n, then
-        # take exactly n items.
-        copies_needed = math.ceil(n / len(x.v))
-        return List((x.v*copies_needed)[:n])
-    else: # take
-        return List(x.v[:n])
-
-def reshape(x, shape, start=0):
+def fill(x, n):
+    """Returns n items cycling through the list x, or n copies of the atom x, built in one pass by
+    modular indexing. The result is a NumPy array for numbers, a str for chars and a Python list otherwise."""
+    if is_atom(x):
+        if is_(x, Char): return chr(x.v) * n
+        if np is not None and is_(x, Num):
+            try: return np.full(n, x.v)
+            except OverflowError: pass
+        return [x]*n
+    if count(x) == 0: raise LengthError(x)
+    if is_(x, Vec): return np.resize(x.a, n)
+    if is_(x, Str): return (x.s * -(-n // len(x.s)))[:n]
+    base, idx = storage(x)
+    m = len(idx)
+    return [base[idx[i % m]] for i in range(n)]
+
+def wrap(buf):
+    "Makes a flat k list from the result of fill."
+    if type(buf) is str: return Str(buf)
+    return List(buf) if type(buf) is list else Vec(buf)
+
+def reshape(x, shape):
     if shape == []:
         return List([])
-
-    if is_atom(x): # l#a
-        # build a list of the atom in the desired shape
-        if len(shape) == 1: # repeat
-            return List([x]*shape[0])
-        return List([ reshape(x, shape[1:]) for _ in range(shape[0]) ])
-    elif is_(x, List): # l#l
-        # print("shape:", shape)
-
-        if len(shape) == 1: # single dimension
-            end = start+shape[0]
-
-            if len(x.v) < end: # if we need to, extend the list by repeating it
-                # starting where we left off, instead of the beginning.
-                x = repeat_list(x, end)
-            return List( x.v[start:end] )
-        else: # multi-dimensional
-            # build a list of rows with incremental starting indices.
-            # for each row, we increment start by the size of that row (and the sizes of all of _its_ rows, recursively)
-            # so that we remember where we left off in the list in the previous row.
-            rowSize = product(shape[1:])
-            return List([ reshape(x, shape[1:], start=start + row*rowSize) for row in range(shape[0]) ])
+    buf = fill(x, product(shape))
+    if len(shape) == 1: return wrap(buf)
+    return Array(buf, tuple(shape))
 
 def op_hash(x, y):
     if is_(x, Num): # take (n#l or n#a)
+        if is_(y, List) and abs(x.v) <= count(y): return take_view(y, x.v)
+        if is_(y, List) and x.v < 0 and count(y) > 0: # repeats cyclically, ending with the last item
+            n, m = count(y), -x.v
+            return gather(y, List([Num((i - m) % n) for i in range(m)]))
+        if x.v < 0 and is_atom(y): return List([y]*-x.v)
+        if is_(y, Vec) and count(y) > 0: return Vec(np.resize(y.a, x.v)) # repeats cyclically
+        if is_(y, Str) and count(y) > 0 or is_(y, Char): return Str(fill(y, x.v))
         if is_(y, List):
             xs = y.v
-            if len(y.v) < x.v: # repeat
+            if count(y) < x.v: # repeat
                 # make enough copies needed to repeat x times, then
                 # take exactly x items.
-                copies_needed = math.ceil(x.v / len(y.v))
+                copies_needed = math.ceil(x.v / count(y))
                 xs = (xs*copies_needed)[:x.v]
             else: # take
                 xs = xs[:x.v]
@@ -170,16 +738,311 @@ def op_hash(x, y):
         return reshape(y, shape)
     return InternalError("op_hash")
 
+# Memoization. Pure Functions can opt in to caching their results by their arguments. A Function
+# can also read names it doesn't bind, and call Functions that do, so the key also has the
+# current values of those names. And since Num(1) == Num(1.0), it has the types of the numbers too.
+
+def impure_assigns(fn):
+    """Returns the names fn (or a Function inside it) assigns other than its own arguments. Any
+    other name might be bound in an enclosing scope, so assigning it is a side effect."""
+    names, todo = [], [(expr, fn) for expr in fn.body]
+    while todo:
+        expr, owner = todo.pop()
+        if is_(expr, Assign) and expr.name not in owner.args or is_(expr, Depend): names.append(expr.name)
+        if is_(expr, Function): owner = expr
+        todo.extend((child, owner) for child in children(expr))
+    return names
+
+def footprint(x):
+    "Roughly how many atoms x holds, for bounding the size of a Memo."
+    if is_(x, Range): return 1
+    if is_(x, Vec) or is_(x, Buf) or is_(x, Str): return count(x)
+    if is_(x, Array): return product(x.shape) if type(x.buf) is not list else sum(map(footprint, x.v))
+    if is_(x, List): return 1 + sum(map(footprint, x.v))
+    return 1
+
+def kinds(x):
+    "The types of the numbers in x, which values that are equal can differ in."
+    if is_(x, Num): return type(x.v)
+    if is_(x, Range): return x.is_int()
+    if is_(x, Vec): return x.a.dtype.kind
+    if is_(x, Buf): return x.m.format
+    if is_(x, Array) and type(x.buf) is not list: return x.buf.dtype.kind if type(x.buf) is not str else None
+    if is_(x, Str) or is_(x, Lines): return None
+    if is_(x, List): return tuple(map(kinds, x.v))
+    return None
+
+_free = {} # Function -> the names it uses but doesn't bind
+
+def free_value(f, name):
+    "The value of a name the Function f uses but doesn't bind: from the frames a compiled Lambda closes over, else the env."
+    return f.resolve(name) if callable(f) else lookup(name)
+
+def free_values(f):
+    "The names f uses but doesn't bind, and those of the Functions they are bound to and so on, with their values."
+    r, seen, todo = [], set(), [f]
+    while todo:
+        g = todo.pop()
+        names = _free.get(g)
+        if names is None: names = _free[g] = free_names(g)
+        for name in names:
+            if (id(g), name) in seen: continue
+            seen.add((id(g), name))
+            v = free_value(g, name)
+            r.append((name, v))
+            if is_(v, Function): todo.append(v)
+    return tuple(r)
+
+def memo_key(f, args):
+    values = free_values(f)
+    return args, values, tuple(map(kinds, args)), tuple(kinds(v) for _, v in values)
+
+class Memo:
+    """A least recently used cache of the results of one Function, keyed by memo_key (whose values
+    hash structurally). It holds at most maxsize results and, if maxitems is set, results with at
+    most maxitems atoms in total."""
+    def __init__(self, maxsize=1024, maxitems=None):
+        self.maxsize, self.maxitems = maxsize, maxitems
+        self.cache = collections.OrderedDict()
+        self.items = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, args):
+        r = self.cache.get(args)
+        if r is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.cache.move_to_end(args)
+        return r[0]
+
+    def put(self, args, v):
+        size = footprint(v)
+        if self.maxitems is not None and size > self.maxitems: return
+        self.cache[args] = (v, size)
+        self.items += size
+        while len(self.cache) > self.maxsize or self.maxitems is not None and self.items > self.maxitems:
+            _, (_, size) = self.cache.popitem(last=False)
+            self.items -= size
+            self.evictions += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self.cache), "items": self.items}
+
+def memoize(f, maxsize=1024, maxitems=None):
+    """Caches the results of f in the current Interpreter. f must not assign anything but its own
+    arguments. Returns its Memo."""
+    names = impure_assigns(f)
+    if names:
+        raise GeneralError("can't memoize a Function that assigns %s" % ", ".join(sorted(set(names))))
+    memo = current().memos[f] = Memo(maxsize, maxitems)
+    return memo
+
+def unmemoize(f): current().memos.pop(f, None)
+
+# Dependencies. name::expr makes the global name a view: its value is expr's, computed when name
+# is looked up rather than when it is defined. A view remembers the values the names expr uses
+# (and the names the Functions bound to those use, and so on) had when it was last computed, and
+# only recomputes once one of them has been bound to another value (values are never changed in
+# place, so that is a test of identity). Views over views work the same way, since looking up a
+# view refreshes it first. A view aggregating a global list, +/v, */v or #v, doesn't wait:
+# v: v, y folds y into it on the spot.
+
+class Dependent:
+    """The entry of the view name::expr in the globals. run evaluates expr. inputs maps each name
+    expr uses to its value when v was computed, through holds the values of the names the
+    Functions among those use (see free_values), and aggregate is (verb, name) for +/name, */name
+    and #name."""
+    def __init__(self, name, expr, run=None):
+        self.name, self.expr = name, expr
+        self.run = run or (lambda: eval(expr))
+        self.inputs = dict.fromkeys(free_names(expr))
+        self.through = ()
+        self.v = None
+        self.busy = False
+        self.aggregate = aggregate_of(expr)
+        self.hits = self.recomputes = self.increments = 0
+
+    def value(self):
+        if self.busy: raise GeneralError("circular view '%s'" % self.name)
+        self.busy = True
+        try:
+            current = {name: lookup(name) for name in self.inputs}
+            through = tuple(v for f in current.values() if is_(f, Function) for _, v in free_values(f))
+            if (self.v is not None and all(current[name] is v for name, v in self.inputs.items())
+                and len(through) == len(self.through) and all(map(operator.is_, through, self.through))):
+                self.hits += 1
+                return self.v
+            self.v = None
+            self.v = self.run()
+            self.inputs, self.through = current, through
+            self.recomputes += 1
+            return self.v
+        finally: self.busy = False
+
+    def appended(self, old, new, tail):
+        "The list this view aggregates went from old to new, which is old joined with tail (or None if it isn't)."
+        verb, name = self.aggregate
+        if tail is None or self.v is None or self.inputs[name] is not old or not is_(old, List): return
+        if not is_(tail, List): tail = List([tail])
+        try: v = Num(self.v.v + count(tail)) if verb == "#" else dyads[verb](self.v, apply_adverb("/", verb, tail))
+        except Exception: return # left for the recompute to report
+        self.v, self.inputs[name] = v, new
+        self.increments += 1
+
+    def stats(self):
+        return {"hits": self.hits, "recomputes": self.recomputes, "increments": self.increments}
+
+def free_names(expr):
+    "The names expr uses, other than the args of the Functions in it, in order."
+    names, todo = {}, [(expr, ())]
+    while todo:
+        e, args = todo.pop()
+        if is_(e, Var) and e.name not in args: names[e.name] = None
+        if is_(e, Function): args = args + tuple(e.args)
+        todo.extend((child, args) for child in reversed(children(e)))
+    return list(names)
+
+def aggregate_of(expr):
+    if is_(expr, AdverbMonadApply) and expr.adv == "/" and is_(expr.v, Var):
+        op = expr.op
+        if is_(op, Verb) and not op.forcemonad and op.name in ("+", "*"): return op.name, expr.v.name
+    if is_(expr, MonadApply) and expr.op == "#" and is_(expr.v, Var): return "#", expr.v.name
+    return None
+
+def define(name, expr, run=None):
+    "Makes the global name the view name::expr. Like an assignment, it returns the value it binds, here an empty list."
+    env = scopes()
+    rebinding(env, name, None)
+    d = env[0][name] = Dependent(name, expr, run)
+    if d.aggregate: env.watch.setdefault(d.aggregate[1], []).append(d)
+    return List([])
+
+def rebinding(env, name, v):
+    """Called before the global name is bound to v, or to a view if v is None: stops the view it
+    may have been, and lets the views aggregating it fold in what v appended to it."""
+    old = env[0].get(name)
+    if type(old) is Dependent and old.aggregate:
+        watchers = env.watch[old.aggregate[1]]
+        watchers.remove(old)
+        if not watchers: del env.watch[old.aggregate[1]]
+    watchers = env.watch.get(name)
+    if watchers and v is not None:
+        joined, _current.joined = _current.joined, None
+        tail = joined[2] if joined is not None and joined[0] is v and joined[1] is old else None
+        for d in watchers: d.appended(old, v, tail)
+
+def is_append(expr):
+    "Is expr the assignment v: v, y, whose join views aggregating v can fold in?"
+    v = expr.v
+    return is_(v, DyadApply) and verb_name(v.op) == "," and is_(v.l, Var) and v.l.name == expr.name
+
+def appending(assign):
+    "Runs assign, an append (see is_append), letting its join record its operands until rebinding reads them."
+    joining, _current.joining = _current.joining, True
+    try: return assign()
+    finally: _current.joining, _current.joined = joining, None
+
+def view_stats():
+    "The hits, recomputes and increments (appends folded in) of each view in the current env's globals."
+    return {name: d.stats() for name, d in scopes()[0].items() if type(d) is Dependent}
+
+# Profiling. It is off until start_profiler() is called, and until then each hook costs one
+# test of the current Interpreter's profiler.
+
+def fn_label(f):
+    "Names a Function in profiles: by what it was assigned to, else by where it was parsed."
+    if callable(f): f = f.template.fn # compiled
+    name, pos = getattr(f, "name", None), getattr(f, "pos", None)
+    if name: return name
+    if pos: return "{lambda}@%d:%d" % pos
+    return "{lambda}"
+
+def op_label(op):
+    return fn_label(op) if is_(op, Function) else verb_name(op)
+
+class Profiler:
+    """Records calls, cumulative and self time, and the total and largest input sizes (in items)
+    of each verb, adverb and Function, plus self time by call stack for flame graphs."""
+    def __init__(self):
+        self.stats = {} # key -> [calls, cumulative, self, items, max items]
+        self.stacks = collections.Counter() # tuple of keys -> self time
+        self.stack = [] # [key, start, time in callees] of the calls in progress
+        self.active = collections.Counter() # key -> calls of it in progress, so recursion isn't counted twice
+
+    def call(self, key, size, f, *args):
+        self.stack.append([key, time.perf_counter(), 0.0])
+        self.active[key] += 1
+        try: return f(*args)
+        finally:
+            _, start, inner = self.stack.pop()
+            elapsed = time.perf_counter() - start
+            self.active[key] -= 1
+            s = self.stats.get(key)
+            if s is None: s = self.stats[key] = [0, 0.0, 0.0, 0, 0]
+            s[0] += 1
+            if not self.active[key]: s[1] += elapsed
+            s[2] += elapsed - inner
+            s[3] += size
+            s[4] = max(s[4], size)
+            self.stacks[tuple(c[0] for c in self.stack) + (key,)] += elapsed - inner
+            if self.stack: self.stack[-1][2] += elapsed
+
+    def report(self, sort="self"):
+        "A text table, sorted by self time (or calls, cumulative or items)."
+        col = {"calls": 0, "cumulative": 1, "self": 2, "items": 3}[sort]
+        lines = ["%-24s %8s %12s %12s %10s %10s" % ("verb", "calls", "cumul ms", "self ms", "avg items", "max items")]
+        for key, s in sorted(self.stats.items(), key=lambda kv: -kv[1][col]):
+            lines.append("%-24s %8d %12.3f %12.3f %10.1f %10d" % (key, s[0], s[1]*1e3, s[2]*1e3, s[3] / s[0], s[4]))
+        return "\n".join(lines)
+
+    def collapsed(self):
+        "Self time in microseconds by call stack, in the collapsed format of flamegraph.pl."
+        return "\n".join("%s %d" % (";".join(stack), round(t*1e6)) for stack, t in sorted(self.stacks.items()))
+
+def start_profiler():
+    "Starts profiling in the current Interpreter, returning the Profiler that will have the results."
+    p = current().profiler = Profiler()
+    return p
+
+def stop_profiler():
+    "Stops profiling, returning the Profiler with the results."
+    interp = current()
+    p, interp.profiler = interp.profiler, None
+    return p
+
+@contextlib.contextmanager
+def profiling():
+    "with profiling() as p: ... profiles the block, leaving the results in p."
+    p = start_profiler()
+    try: yield p
+    finally: stop_profiler()
+
 def apply_fn(f, args):
     if len(f.args) != len(args):
         raise LengthError("apply_fn arg length mismatch")
+    interp = _current.interp
+    memo = interp.memos.get(f) if interp.memos else None
+    if memo is not None:
+        key = memo_key(f, tuple(args))
+        r = memo.get(key)
+        if r is not None: return r
+    if interp.profiler is not None: r = interp.profiler.call(fn_label(f), sum(map(count, args)), call_fn, f, args)
+    else: r = call_fn(f, args)
+    if memo is not None: memo.put(key, r)
+    return r
+
+def call_fn(f, args):
+    "Runs the body of f on args."
+    if callable(f): return f.call(args) # compiled, see compiler.py
     r = None # TODO: what is the default value?
-    pushScope()
-    for name, v in zip(f.args, args):
-        bind(name, v)
-    for expr in f.body:
-        r = eval(expr)
-    popScope()
+    env = scopes()
+    env.append({name: v for name, v in zip(f.args, args)}) # always new locals, even if an outer scope has the names
+    try:
+        for expr in f.body:
+            r = eval(expr)
+    finally: env.pop()
     return r
 
 def op_at(x, y):
@@ -190,31 +1053,23 @@ def op_dot(x, y):
     if is_(x, Function) and is_(y, List): # dot-apply
         return apply_fn(x, y.v)
     if is_(x, List) and is_(y, List):
-        if len(y.v) == 1 and is_(y.v[0], List): # return a list indexed into x
-            return List([x.v[i.v] for i in y.v[0].v])
+        if count(y) == 1 and is_(item(y, 0), List): # return a list indexed into x
+            return gather(x, item(y, 0))
         else: # index at depth
             xs = x
             for i in y.v:
-                print("xs:", xs, "y:", y)
-                xs = xs.v[i.v]
+                xs = item(xs, i.v)
             return xs
     raise InternalError("op_dot")
 
 def op_underscore(x, y):
     if is_(x, Num) and is_(y, List): # drop (n_l)
-        return List(y.v[x.v:])
+        return drop_view(y, x.v)
     if is_(x, Num): return y
     raise InternalError("op_underscore")
 
-def apply_dyad(expr):
-    if is_(expr.op, Verb): expr.op = expr.op.name
-    if is_(expr.op, Function): return apply_fn(expr.op, [eval(expr.l), eval(expr.r)]) # function dyad
-    return {"+": op_plus, "-": op_minus, "*": op_star, "#": op_hash, "@": op_at,
-            ".": op_dot, "_": op_underscore
-           }[expr.op](eval(expr.l), eval(expr.r))
-
 def op_hash_m(x): # count (#l)
-    if is_(x, List): return Num(len(x.v))
+    if is_(x, List): return Num(count(x))
     elif is_atom(x): return Num(1)
     return InternalError("")
 
@@ -223,102 +1078,480 @@ def op_comma_m(x): # enlist (,)
 
 def op_bang_m(x):
     if is_(x, Num): # int (!n)
+        if type(x.v) is not int: raise TypeError(x)
+        if np is not None: return Range(0, 1, max(x.v, 0))
         return List(list(map(Num, range(x.v))))
     raise InternalError("op_bang_m")
 
 def op_minus_m(x):
     if is_(x, Num): return Num(-x.v)
+    if is_(x, Range) and x.start != INT64_MIN and x.start + x.step*(x.n - 1) != INT64_MIN: return Range(-x.start, -x.step, x.n)
+    if is_(x, Vec):
+        a = wide(x.a)
+        return exact(operator.neg, x.a) if a is None or wraps(operator.neg, a) else Vec(-a)
+    if is_(x, List): return List(list(map(op_minus_m, x.v)))
     raise InternalError("op_minus_m")
 
 def op_star_m(x):
-    if is_(x, List): return x.v[0]
+    if is_(x, List): return item(x, 0)
     raise InternalError("op_star_m")
 
+# Grading. Equal items always keep their original order, for both grade up and grade down.
+
+def sort_key(x):
+    "A plain Python value that orders like x, so sorting never calls back into Num.__lt__."
+    if is_(x, Str): return tuple(map(ord, x.s))
+    if is_(x, List): return tuple(map(sort_key, x.v))
+    return x.v
+
+def counting_grade(vs, lo, hi, descending):
+    "Grades the ints vs, all in lo..hi, with a stable counting sort."
+    counts = [0] * (hi - lo + 1)
+    for v in vs: counts[v - lo] += 1
+    starts, pos = [0] * len(counts), 0
+    for b in (reversed(range(len(counts))) if descending else range(len(counts))):
+        starts[b] = pos
+        pos += counts[b]
+    r = [0] * len(vs)
+    for i, v in enumerate(vs):
+        b = v - lo
+        r[starts[b]] = i
+        starts[b] += 1
+    return r
+
+def grade(x, descending=False):
+    "Returns the indices that sort the list x up (or down), as a k list."
+    n = count(x)
+    if is_(x, Vec):
+        a = x.a
+        if a.dtype.kind == "i" and n:
+            lo, hi = int(a.min()), int(a.max())
+            if hi - lo < 1 << 16: a = (a - lo).astype(np.uint16) # NumPy radix sorts small ints
+        if descending: # stable sort of the reversed list, reversed again
+            return Vec((n - 1) - np.argsort(a[::-1], kind="stable")[::-1])
+        return Vec(np.argsort(a, kind="stable"))
+    if is_(x, Str):
+        vs = list(map(ord, x.s))
+        if vs and max(vs) - min(vs) <= 2*n + 256: return int_vector(counting_grade(vs, min(vs), max(vs), descending))
+        return int_vector(sorted(range(n), key=vs.__getitem__, reverse=descending))
+    items = x.v
+    if items and all(is_(v, Str) for v in items): # strs order like the tuples of their chars
+        keys = [v.s for v in items]
+        return int_vector(sorted(range(n), key=keys.__getitem__, reverse=descending))
+    if all(is_(v, Num) and type(v.v) is int for v in items) or all(is_(v, Char) for v in items):
+        vs = [v.v for v in items]
+        if vs and max(vs) - min(vs) <= 2*n + 256: r = counting_grade(vs, min(vs), max(vs), descending)
+        else: r = sorted(range(n), key=vs.__getitem__, reverse=descending)
+    else: # floats and mixed data
+        keys = list(map(sort_key, items))
+        r = sorted(range(n), key=keys.__getitem__, reverse=descending) # reverse=True is still stable
+    return int_vector(r)
+
 def op_less_than_m(x): # asc
-    if is_(x, List):
-        sorted_x = sorted(((v, i) for i,v in enumerate(x.v)), key=lambda x: x[0]) # x sorted, maintaining indices
-        return List([Num(i) for _,i in sorted_x])
+    if is_(x, List): return grade(x)
     raise InternalError("op_less_than_m")
 
+def op_greater_than_m(x): # desc
+    if is_(x, List): return grade(x, descending=True)
+    raise InternalError("op_greater_than_m")
+
+# Files. 1:f maps the raw binary file f as a vector, and 1:(f; t) as one of type t, a char of
+# "xhijefc" like K's. 0:f maps the text file f as a list of lines. 1:(f; l) and 0:(f; l) write
+# the vector, or the lines, l to f. Writing returns f.
+
+FILE_TYPES = {"x": "B", "h": "h", "i": "i", "j": "q", "e": "f", "f": "d", "c": "B"} # type -> struct format
+
+def text(s):
+    "Makes a k string of the Python str s."
+    return List([Char(ord(c)) for c in s]) if len(s) != 1 else Char(ord(s))
+
+def is_text(x):
+    "Is x a char atom or a list of chars?"
+    if is_(x, Buf): return x.chars
+    if is_(x, Str): return True
+    return is_(x, Char) or is_(x, List) and not is_(x, Vec) and all(is_(c, Char) for c in x.v)
+
+def path_of(x):
+    "The file name in the k string x."
+    if not is_text(x): raise TypeError(x)
+    if is_(x, Str): return x.s
+    return "".join(chr(c.v) for c in (x.v if is_(x, List) else [x]))
+
+def map_file(path):
+    "Returns a read-only memoryview of the bytes of the file at path, memory-mapped unless it is empty."
+    with open(path, "rb") as f:
+        try: return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError: return memoryview(b"") # mmap refuses empty files
+    # the mapping stays valid after the file is closed
+
+def read_vector(path, t="j"):
+    """Maps the file at path as a vector of type t, as a Vec over the mapping if there is NumPy.
+    It keeps the file's item type, but arithmetic on it works in 64 bits, like on any other list."""
+    if t not in FILE_TYPES: raise TypeError(t)
+    m = map_file(path)
+    fmt = FILE_TYPES[t]
+    if len(m) % array.array(fmt).itemsize: raise LengthError("%s isn't a whole number of %r items" % (path, t))
+    if np is not None and t != "c": return Vec(np.frombuffer(m, dtype=np.dtype(fmt)))
+    return Buf(m.cast(fmt), chars=t == "c")
+
+def read_lines(path):
+    "Maps the text file at path as Lines, finding where each line starts in one pass."
+    m = map_file(path)
+    data = m.obj # the mmap, which can search without copying
+    starts, i = [0], data.find(b"\n")
+    while i != -1:
+        starts.append(i + 1)
+        i = data.find(b"\n", i + 1)
+    if starts[-1] != len(m): starts.append(len(m)) # a last line without a line ending
+    return Lines(m, starts)
+
+def vector_bytes(x):
+    "The raw bytes of the vector x: as it is stored if it is a Buf or Vec, else as 8 byte ints, 8 byte floats or 1 byte chars."
+    if is_(x, Buf): return x.m.tobytes()
+    if is_(x, Vec): return x.a.tobytes()
+    if is_(x, Char) or is_(x, Num): x = List([x])
+    if not is_(x, List): raise TypeError(x)
+    items = x.v
+    if all(is_(c, Char) for c in items): return bytes(c.v for c in items)
+    if not all(is_(n, Num) for n in items): raise TypeError(x)
+    vs = [n.v for n in items]
+    return array.array("q" if all(type(v) is int for v in vs) else "d", vs).tobytes()
+
+def write_file(path, data):
+    with open(path, "wb") as f: f.write(data)
+
+def joins_exactly(a, b):
+    "Can the arrays a and b be joined into one array without changing any of their items?"
+    if a.dtype.kind in "iu" and b.dtype.kind in "iu": return np.result_type(a, b).kind in "iu"
+    return a.dtype.kind == b.dtype.kind == "f"
+
+def op_comma(x, y): # join (x,y)
+    if np is not None and is_(x, Vec) and is_(y, Num): y = pack([y]) # a List if y doesn't fit in 64 bits
+    if (is_(x, Str) or is_(x, Char)) and (is_(y, Str) or is_(y, Char)):
+        r = Str((x.s if is_(x, Str) else chr(x.v)) + (y.s if is_(y, Str) else chr(y.v)))
+    elif np is not None and is_(x, Vec) and is_(y, Vec) and joins_exactly(x.a, y.a):
+        r = Vec(np.concatenate([x.a, y.a]))
+    else: r = pack((x.v if is_(x, List) else [x]) + (y.v if is_(y, List) else [y]))
+    if _current.joining: _current.joined = (r, x, y) # so that binding r in place of x can update the views of x, see rebinding
+    return r
+
+def op_colon(x, y):
+    if is_(x, Num) and x.v in (0, 1): # file I/O (0:f, 1:f, 0:(f; l) and 1:(f; l))
+        if is_(y, List) and count(y) == 2 and is_(item(y, 0), List): # a file name and an argument
+            f, arg = item(y, 0), item(y, 1)
+            if x.v == 1 and is_(arg, Char): return read_vector(path_of(f), chr(arg.v))
+            if x.v == 1: write_file(path_of(f), vector_bytes(arg))
+            else:
+                lines = [arg] if is_text(arg) and count(arg) else arg.v
+                write_file(path_of(f), b"".join(vector_bytes(l) + b"\n" for l in lines))
+            return f
+        return read_vector(path_of(y)) if x.v == 1 else read_lines(path_of(y))
+    raise InternalError("op_colon")
+
+dyads = {"+": op_plus, "-": op_minus, "*": op_star, "#": op_hash, "@": op_at,
+         ".": op_dot, "_": op_underscore, ",": op_comma, ":": op_colon}
+
+monads = {"#": op_hash_m, ",": op_comma_m, "!": op_bang_m, "-": op_minus_m, "*": op_star_m,
+          "<": op_less_than_m, ">": op_greater_than_m}
+
+def verb_name(op):
+    "Returns the name of a built-in verb, or op itself if it is a Function."
+    return op.name if is_(op, Verb) else op
+
 def monadic(verb):
     # TODO: we should really use Verb everywhere
-    if is_(verb, Verb): return verb.forcemonad or monadic(verb.verb)
+    if is_(verb, Verb): return verb.forcemonad
     if is_(verb, Function): return len(verb.args) == 1
-    return True # XXX
+    return False
+
+def as_dyad(op):
+    "Returns a Python function calling op with two arguments."
+    if is_(op, Function): return lambda x, y: apply_fn(op, [x, y])
+    return dyads[verb_name(op)]
+
+def as_monad(op):
+    "Returns a Python function calling op with one argument."
+    if is_(op, Function): return lambda x: apply_fn(op, [x])
+    return monads[verb_name(op)]
+
+def apply_dyad(expr):
+    if is_(expr.op, Function): return apply_fn(expr.op, [eval(expr.l), eval(expr.r)]) # function dyad
+    name = verb_name(expr.op)
+    profiler = _current.interp.profiler
+    if profiler is not None:
+        l, r = eval(expr.l), eval(expr.r)
+        return profiler.call(name, count(l) + count(r), dyads[name], l, r)
+    return dyads[name](eval(expr.l), eval(expr.r))
 
 def apply_monad(expr):
-    if is_(expr.op, Verb): expr.op = expr.op.name
     if is_(expr.op, Function): return apply_fn(expr.op, [eval(expr.v)]) # function monad
-    return {"#": op_hash_m, ",": op_comma_m, "!": op_bang_m, "-": op_minus_m, "*": op_star_m,
-            "<": op_less_than_m
-           }[expr.op](eval(expr.v))
+    name = verb_name(expr.op)
+    profiler = _current.interp.profiler
+    if profiler is not None:
+        v = eval(expr.v)
+        return profiler.call(name + ":", count(v), monads[name], v)
+    return monads[name](eval(expr.v))
 
-def apply_monad_adverb(expr):
-    if is_(expr.op, Verb): expr.op = expr.op.name
-    if expr.adv in ("/", "\\"): # over, scan
-        xs = eval(expr.v)
-        initial = xs.v[0]
-        # special cased initial folding values
-        if expr.op == "+": initial = Num(0)
-        elif expr.op == "*": initial = Num(1)
-
-        if expr.adv == "/": # over
-            return fold(lambda x, acc: eval(DyadApply(acc, expr.op, x)), xs, initial)
+def flat_values(xs):
+    "Returns the Python numbers in xs if it is a flat list of Nums, otherwise None."
+    if is_(xs, Vec): return xs.a.tolist()
+    if is_(xs, Buf): return None if xs.chars else xs.m.tolist()
+    vs = []
+    for x in xs.v:
+        if not is_(x, Num): return None
+        vs.append(x.v)
+    return vs
+
+# Specialized adverb kernels for built-in verbs. Each takes the list argument and returns
+# the result, or None if it doesn't apply and the generic loop should be used instead.
+
+def over_plus(xs): # +/
+    if is_(xs, Range): # closed form
+        n = xs.n
+        if xs.is_int(): return Num(n*xs.start + xs.step*(n*(n-1)//2))
+        return Num(n*xs.start + xs.step*(n*(n-1)/2))
+    if is_(xs, Vec):
+        a = wide(xs.a)
+        if a is None or sum_wraps(a): return Num(sum(xs.a.tolist()))
+        return Num(a.sum().item())
+    vs = flat_values(xs)
+    return None if vs is None else Num(sum(vs))
+
+def sum_wraps(a):
+    "Could a partial sum of the array a wrap around at 64 bits?"
+    b = int_bounds(a)
+    return b is not None and bounds_after(operator.mul, [b, (0, len(a))]) is False
+
+def over_star(xs): # */
+    if is_(xs, Range): return Num(math.prod(xs.values(), start=1 if xs.is_int() else 1.0)) # one streaming pass
+    vs = flat_values(xs) # exact, doesn't wrap at 64 bits
+    return None if vs is None else Num(math.prod(vs))
+
+def scan_plus(xs): # +\
+    if is_(xs, Vec):
+        a = wide(xs.a)
+        if a is not None and not sum_wraps(a): return Vec(a.cumsum())
+    vs = flat_values(xs)
+    return None if vs is None else pack(list(map(Num, itertools.accumulate(vs))))
+
+def scan_star(xs): # *\
+    vs = flat_values(xs)
+    return None if vs is None else pack(list(map(Num, itertools.accumulate(vs, operator.mul))))
+
+def each_atomic(f):
+    "each for a monad that already applies to every item of a flat list, like -"
+    def each(xs):
+        if is_(xs, Vec) or flat_values(xs) is not None: return f(xs)
+    return each
+
+over_kernels = {"+": over_plus, "*": over_star}
+scan_kernels = {"+": scan_plus, "*": scan_star}
+each_kernels = {"-": each_atomic(op_minus_m)}
+
+def converge(f, x):
+    """Applies f to x, then to the result, and so on, until it returns a value seen before. Returns
+    the distinct values in order. Each value is hashed once, so finding a repeat takes O(1) and any
+    cycle ends the loop, not just returning to x or a fixed point. The current Interpreter's
+    converge_limit bounds the steps, and its converge_info tells how many there were."""
+    interp = current()
+    seen = {} # hash -> indices into r of the values with that hash
+    r = []
+    v = x
+    while True:
+        h = hash(v)
+        same = seen.get(h)
+        if same is not None:
+            for i in same:
+                if r[i] == v:
+                    interp.converge_info["iterations"], interp.converge_info["cycle"] = len(r), len(r) - i
+                    return r
+        seen.setdefault(h, []).append(len(r))
+        r.append(v)
+        if interp.converge_limit is not None and len(r) > interp.converge_limit:
+            raise GeneralError("converge didn't finish within %d iterations" % interp.converge_limit)
+        v = f(v)
+
+class Thunk:
+    "The value of a Delay: calls run the first time it is forced, and keeps the result."
+    __slots__ = ("run", "v")
+    def __init__(self, run): self.run, self.v = run, None
+    def force(self):
+        if self.run is not None: self.v, self.run = self.run(), None
+        return self.v
+
+def force(v): return v.force() if type(v) is Thunk else v
+
+# Fused kernels. The tree of a Fused node is a chain of the dyads +, - and * and the monad -
+# over Num constants and Var("0"), Var("1")... standing for the values of its args, in order.
+# When the values are numbers and flat lists of numbers, the chain runs as one generated Python
+# function, over whole arrays with NumPy or else item by item, without intermediate lists.
+# Anything else, like nested lists or lazy Ranges, goes through the verbs as usual.
+
+FUSIBLE_DYADS = {"+", "-", "*"}
+FUSIBLE_MONADS = {"-"}
+
+_kernels = {} # tree -> its function
+
+def kernel(tree):
+    "Returns the Python function of numbers that the Fused tree computes, generating it once."
+    f = _kernels.get(tree)
+    if f is None:
+        ns, names = {}, set()
+        def src(t):
+            if is_(t, Var):
+                names.add(int(t.name))
+                return "a" + t.name
+            if is_(t, Num):
+                ns["c%d" % len(ns)] = t.v # by name, since repr doesn't round-trip inf and nan
+                return "c%d" % (len(ns) - 1)
+            if is_(t, MonadApply): return "(-%s)" % src(t.v)
+            return "(%s %s %s)" % (src(t.l), t.op, src(t.r))
+        body = src(tree)
+        exec("def f(%s): return %s\n" % (", ".join("a%d" % i for i in range(max(names) + 1)), body), ns)
+        f = _kernels[tree] = ns["f"]
+    return f
+
+def tree_bounds(tree, bounds):
+    """The least and greatest value of the Fused tree over ints within bounds (None for a float's),
+    or False if it or a step on the way might not fit in 64 bits."""
+    if is_(tree, Var):
+        b = bounds[int(tree.name)]
+        return b if b is None else bounds_after(operator.pos, [b])
+    if is_(tree, Num): return (tree.v, tree.v) if type(tree.v) is int else None
+    if is_(tree, MonadApply): f, args = operator.neg, [tree.v]
+    else: f, args = {"+": operator.add, "-": operator.sub, "*": operator.mul}[tree.op], [tree.l, tree.r]
+    bs = [tree_bounds(t, bounds) for t in args]
+    if any(b is False for b in bs): return False
+    if None in bs: return None
+    return bounds_after(f, bs)
+
+def apply_tree(tree, values):
+    "Computes the Fused tree on values with the ordinary verbs."
+    if is_(tree, Var): return values[int(tree.name)]
+    if is_(tree, Num): return tree
+    if is_(tree, MonadApply): return monads[tree.op](apply_tree(tree.v, values))
+    return dyads[tree.op](apply_tree(tree.l, values), apply_tree(tree.r, values))
+
+def run_fused(expr, values):
+    if any(is_(x, Range) for x in values): return apply_tree(expr.tree, values) # keep them lazy
+    lists = [x for x in values if is_(x, List)]
+    if not all(is_(x, Num) or is_(x, List) for x in values): return apply_tree(expr.tree, values)
+    if not lists: return Num(kernel(expr.tree)(*[x.v for x in values]))
+    n = count(lists[0])
+    if np is not None and all(is_(x, Vec) for x in lists):
+        if any(count(x) != n for x in lists): raise LengthError(*lists)
+        args = [x.a if is_(x, Vec) else x.v for x in values]
+        wides = [wide(a) if is_(x, Vec) else a for x, a in zip(values, args)]
+        if any(a is None for a in wides) or tree_bounds(expr.tree, [int_bounds(a) for a in wides]) is False:
+            return exact(kernel(expr.tree), *args)
+        return Vec(kernel(expr.tree)(*wides))
+    cols = [flat_values(x) if is_(x, List) else itertools.repeat(x.v) for x in values]
+    if any(c is None for c in cols): return apply_tree(expr.tree, values) # not just numbers, so the error is eval's
+    if any(count(x) != n for x in lists): raise LengthError(*lists)
+    return pack(list(map(Num, map(kernel(expr.tree), *cols))))
+
+def apply_fused(expr, values):
+    profiler = _current.interp.profiler
+    if profiler is not None: return profiler.call("fused", sum(map(count, values)), run_fused, expr, values)
+    return run_fused(expr, values)
+
+parallel = None # a parallel.Pool running large adverbs on several processes, see parallel.py
+
+def apply_adverb(adv, op, xs):
+    "Applies the adverb adv, modifying the verb or Function op, to the value xs."
+    profiler = _current.interp.profiler
+    if profiler is not None: return profiler.call(op_label(op) + adv, count(xs), run_adverb, adv, op, xs)
+    return run_adverb(adv, op, xs)
+
+def run_adverb(adv, op, xs):
+    name = verb_name(op)
+    builtin = not is_(op, Function)
+    if adv in ("/", "\\"): # over, scan
+        if monadic(op): # converge (f/x) and converge-scan (f\\x)
+            r = converge(as_monad(op), xs)
+            return r[-1] if adv == "/" else List(r)
+
+        if builtin:
+            kernel = (over_kernels if adv == "/" else scan_kernels).get(name)
+            r = kernel(xs) if kernel else None
+            if r is not None: return r
+        if parallel is not None:
+            r = parallel.adverb(adv, op, xs)
+            if r is not None: return r
+
+        f = as_dyad(op)
+        # special cased initial folding values, otherwise start from the first item
+        if name == "+": initial = Num(0)
+        elif name == "*": initial = Num(1)
         else:
-            if monadic(expr.op): # scan-fixedpoint
-                initial = xs
-                r = []; v = initial; v_old = v
-                while True:
-                    r.append(v)
-                    v = eval(MonadApply(expr.op, v))
-                    if v == v_old or v == initial: break
-                    v_old = v
-                return List(r)
-            else: # scan
-                return scan(lambda x, acc: eval(DyadApply(acc, expr.op, x)), xs, initial)
-    if expr.adv == "'": # each
-        return List(list(map(lambda x: eval(MonadApply(expr.op, x)), eval(expr.v).v)))
-    raise InternalError("apply_monad_adverb")
+            initial = xs.v[0]
+            xs = List(xs.v[1:])
+        if adv == "/": # over
+            return fold(lambda x, acc: f(acc, x), xs, initial)
+        else: # scan
+            r = scan(lambda x, acc: f(acc, x), xs, initial)
+            if not (name == "+" or name == "*"): r.v.insert(0, initial)
+            return r
+    if adv == "'": # each
+        if builtin and name in each_kernels:
+            r = each_kernels[name](xs)
+            if r is not None: return r
+        if parallel is not None:
+            r = parallel.adverb(adv, op, xs)
+            if r is not None: return r
+        f = as_monad(op)
+        return pack(list(map(f, xs.v))) # a Str if it made Chars
+    raise InternalError("run_adverb")
+
+def apply_monad_adverb(expr):
+    op = eval(expr.op) if is_(expr.op, Var) else expr.op # like f' x
+    return apply_adverb(expr.adv, op, eval(expr.v))
 
 def eval(expr):
-    if is_(expr, Num) or is_(expr, Char) or is_(expr, Function): return expr
-    if is_(expr, List): return List(list(map(eval, expr.v)))
+    if is_(expr, Num) or is_(expr, Char) or is_(expr, Function) or is_(expr, Vec) or is_(expr, Buf) or is_(expr, Str): return expr
+    if is_(expr, List): return pack(list(map(eval, expr.v)))
     if is_(expr, DyadApply): return apply_dyad(expr)
     if is_(expr, MonadApply): return apply_monad(expr)
     if is_(expr, AdverbMonadApply): return apply_monad_adverb(expr)
     if is_(expr, Var):
         v = lookup(expr.name)
         if v is None:
-            raise BindingError("Unbound variable '%s'" % name)
+            raise BindingError("Unbound variable '%s'" % expr.name)
         return v
-    if is_(expr, Assign): return bind(expr.name, eval(expr.v))
+    if is_(expr, Assign):
+        if is_append(expr): return appending(lambda: bind(expr.name, eval(expr.v)))
+        return bind(expr.name, eval(expr.v))
+    if is_(expr, Const): return expr.v
+    if is_(expr, Fused): return apply_fused(expr, [eval(a) for a in expr.args])
+    if is_(expr, Depend): return define(expr.name, expr.v)
+    if is_(expr, Delay):
+        v = expr.v
+        return Thunk(lambda: eval(v))
+    if is_(expr, Force): return force(eval(expr.v))
     raise InternalError("unhandled expr: " + repr(expr))
 
-_testsSucceeded = 0
-_testsFailed = 0
-
 def teq(expr, expected):
-    global _testsSucceeded, _testsFailed
+    interp = current()
     v = eval(expr)
     if not isinstance(expected, Node):
         expected = to_k(expected)
     if v != expected:
         print("FAIL: Got %r, expected %r" % (v, expected))
-        _testsFailed += 1
-    else: _testsSucceeded += 1
+        interp.tests_failed += 1
+    else: interp.tests_succeeded += 1
 
 def terr(expr, exc):
-    global _testsSucceeded, _testsFailed
+    interp = current()
     try: eval(expr)
     except Exception as e:
         if not isinstance(e, exc):
             print("FAIL: Expected failure with %r, got failure with %r" % (exc, e))
-            _testsFailed += 1
+            interp.tests_failed += 1
         else:
-            _testsSucceeded += 1
+            interp.tests_succeeded += 1
     else:
         print("FAIL: Expected failure with %r, but succeeded" % exc)
-        _testsFailed += 1
+        interp.tests_failed += 1
 
 def tests():
     teq( DyadApply(Num(42), '+', Num(8)), 50 )
@@ -349,6 +1582,23 @@ def tests():
     assert recursive_shape(List( [List([Num(1), List(nums(10, 11)), Num(3)]),
                                   List(nums(3, 4, 5, 6, 7))] )) == [[0, [0, 0], 0], [0, 0, 0, 0, 0]]
 
+    # nodes
+    assert Num(5) is Num(5) and Char(97) is Char(97) and Num(10**6) is not Num(10**6)
+    assert hash(Num(1)) == hash(Num(1.0)) and Num(1) != Char(1)
+    assert hash(to_k([1, 2])) == hash(List(nums(1, 2))) == hash(List([Num(1), Num(2.0)]))
+    assert {DyadApply(Num(1), '+', Var('x')): 1}[DyadApply(Num(1), '+', Var('x'))] == 1
+    assert not hasattr(Num(1), "__dict__")
+
+    # cached shapes
+    assert shape_of(matrix) == (2, 2) and is_uniform(matrix) and rank_of(matrix) == 2
+    ragged = to_k([[1, 2], [3]])
+    assert shape_of(ragged) == (2,) and not is_uniform(ragged)
+    assert shape_of(List([Num(1), List(nums(2, 3))])) == (2,)
+    assert not is_uniform(List([Num(1), List(nums(2, 3))]))
+    assert conformable(ragged, to_k([[5, 6], [7]])) and not conformable(ragged, to_k([[5], [6, 7]]))
+    teq( DyadApply(ragged, '+', to_k([[5, 6], [7]])), [[6, 8], [10]] )
+    terr( DyadApply(ragged, '+', to_k([[5], [6, 7]])), LengthError )
+
     # take
     teq( DyadApply(Num(3), '#', Num(42)), [42, 42, 42] ) # n#a
     teq( DyadApply(Num(3), '#', List(nums(1, 2, 3, 4, 5))), [1, 2, 3] ) # n#l take
@@ -383,17 +1633,356 @@ def tests():
                                                                           [[1, 2],
                                                                            [3, 1]]] ] )
 
+    # l#l reshape, 5d, keeps going where the previous row stopped
+    teq( DyadApply(List(nums(1, 2, 3, 4, 5)), '#', List(nums(1, 2, 3, 4, 5))),
+         [[[[[(i*120 + j*60 + k*20 + l*5 + m) % 5 + 1 for m in range(5)] for l in range(4)] for k in range(3)] for j in range(2)] for i in range(1)] )
+    teq( DyadApply(List(nums(2, 0)), '#', List(nums(1, 2))), [[], []] )
+    teq( DyadApply(List(nums(2, 2)), '#', List([Char(97), Char(98), Char(99)])), List([List([Char(97), Char(98)]), List([Char(99), Char(97)])]) )
+    terr( DyadApply(List(nums(2, 2)), '#', List([])), LengthError )
+    big = eval(DyadApply(List(nums(1000, 1000)), '#', MonadApply('!', Num(7))))
+    assert is_(big, Array) and shape_of(big) == (1000, 1000) and count(big) == 1000
+    assert item(item(big, 999), 999) == Num(999999 % 7)
+
     # TODO: Test more cases of reshape
 
     # count
     teq( MonadApply('#', List(nums(1, 2, 3))), 3 ) # #l
     teq( MonadApply('#', Num(3)), 1 ) # #a
 
+    # vectors
+    if np is not None:
+        assert is_(to_k([1, 2, 3]), Vec) and is_(to_k([1.5, 2.0]), Vec) and not is_(to_k([1.5, 2]), Vec)
+        assert to_k([1, 2, 3]) == List(nums(1, 2, 3)) and List(nums(1, 2, 3)) == to_k([1, 2, 3])
+        assert recursive_shape(to_k([1, 2, 3])) == [0, 0, 0]
+    teq( DyadApply(Num(10), '-', to_k([1, 2, 3])), [9, 8, 7] )
+    teq( DyadApply(to_k([1, 2, 3]), '*', Num(2)), [2, 4, 6] )
+    teq( DyadApply(to_k([1, 2, 3]), '*', List(nums(4, 5, 6))), [4, 10, 18] )
+    terr( DyadApply(to_k([1, 2, 3]), '-', to_k([1, 2])), LengthError )
+    teq( MonadApply('-', to_k([1, -2])), [-1, 2] )
+    teq( MonadApply('!', Num(4)), [0, 1, 2, 3] )
+    teq( AdverbMonadApply('/', '+', MonadApply('!', Num(5))), 10 )
+    teq( MonadApply('#', MonadApply('!', Num(-3))), 0 )
+    teq( AdverbMonadApply('/', '+', MonadApply('!', Num(-3))), 0 )
+    terr( MonadApply('!', Num(2.5)), TypeError )
+    terr( DyadApply(Num(0.5), '#', MonadApply('!', Num(4))), TypeError )
+    terr( MonadApply('#', DyadApply(Num(0.5), '_', MonadApply('!', Num(4)))), TypeError )
+    terr( DyadApply(MonadApply('!', Num(3)), '.', List([Num(-1.5)])), TypeError )
+    teq( AdverbMonadApply('/', '*', DyadApply(Num(1), '+', MonadApply('!', Num(25)))), math.factorial(25) )
+
+    # views
+    abc = List([Char(97), Char(98), Char(99)])
+    tails = op_underscore(Num(1), op_underscore(Num(1), abc))
+    assert is_(tails, View) and tails.base is abc.v and tails == List([Char(99)])
+    teq( MonadApply('*', DyadApply(Num(1), '_', abc)), Char(98) )
+    teq( DyadApply(Num(2), '#', DyadApply(Num(1), '_', abc)), List([Char(98), Char(99)]) )
+    teq( DyadApply(abc, '.', List([List(nums(2, 0, 2))])), List([Char(99), Char(97), Char(99)]) )
+    teq( DyadApply(matrix, '.', List(nums(1, 0))), 3 )
+    teq( DyadApply(DyadApply(Num(1), '_', matrix), '.', List(nums(0, 1))), 4 )
+    terr( DyadApply(abc, '.', List([List(nums(3))])), IndexError )
+    terr( DyadApply(to_k([10, 20, 30]), '.', List([List([Num(0.5), Num(1.9)])])), TypeError )
+    terr( DyadApply(to_k([10, 20, 30]), '.', List([to_k([0.5, 1.9])])), TypeError )
+    terr( DyadApply(abc, '.', List([List([Num(0.5)])])), TypeError )
+    v = op_underscore(Num(1), abc)
+    v.v = [Char(120)] # copy on write
+    assert abc == List([Char(97), Char(98), Char(99)]) and v == List([Char(120)])
+    if np is not None:
+        rev = DyadApply(Num(2), '-', MonadApply('!', Num(3)))
+        teq( DyadApply(abc, '.', List([rev])), List([Char(99), Char(98), Char(97)]) ) # reversed, as a strided view
+        teq( DyadApply(DyadApply(Num(1), '_', abc), '.', List([DyadApply(Num(1), '-', MonadApply('!', Num(2)))])), List([Char(99), Char(98)]) )
+        teq( DyadApply(to_k([5, 6, 7]), '.', List([rev])), [7, 6, 5] )
+        teq( DyadApply(to_k([5, 6, 7]), '.', List([to_k([1, 1])])), [6, 6] )
+        teq( MonadApply('*', DyadApply(Num(3), '+', MonadApply('!', Num(10**12)))), 3 )
+
+    # negative take and drop count from the end
+    for xs in (List(nums(1, 2, 3, 4, 5)), List([Char(c) for c in b"abcde"]), List([List([]), Num(1), Char(97), Num(2), Num(3)])):
+        items = eval(xs).v
+        teq( DyadApply(Num(-2), '#', xs), List(items[-2:]) )
+        teq( DyadApply(Num(-2), '_', xs), List(items[:-2]) )
+        teq( DyadApply(Num(-7), '#', xs), List(items[-2:] + items) )
+        teq( DyadApply(Num(-5), '_', xs), [] )
+    teq( DyadApply(Num(-2), '#', Num(7)), [7, 7] )
+
+    # lazy ranges
+    if np is not None:
+        bang = lambda n: MonadApply('!', Num(n))
+        r = eval(DyadApply(Num(2), '*', DyadApply(Num(1), '+', bang(10**12))))
+        assert is_(r, Range) and r.n == 10**12 and r._a is None
+        assert eval(AdverbMonadApply('/', '+', r)) == Num(10**24 + 10**12)
+        assert eval(MonadApply('#', DyadApply(Num(5), '_', bang(10**12)))) == Num(10**12 - 5)
+        assert is_(eval(DyadApply(Num(3), '#', bang(10**12))), Range)
+        teq( DyadApply(Num(3), '#', DyadApply(Num(10), '-', bang(10**12))), [10, 9, 8] )
+        teq( DyadApply(Num(5), '#', bang(3)), [0, 1, 2, 0, 1] )
+        teq( DyadApply(Num(7), '_', bang(5)), [] )
+        teq( DyadApply(Num(-2), '_', bang(5)), [0, 1, 2] )
+        teq( DyadApply(Num(-3), '#', bang(10)), [7, 8, 9] )
+        teq( DyadApply(Num(-7), '_', bang(5)), [] )
+        assert is_(eval(DyadApply(Num(-3), '#', bang(10**12))), Range)
+        teq( DyadApply(bang(3), '*', bang(3)), [0, 1, 4] )
+        teq( DyadApply(bang(3), '-', DyadApply(Num(2), '*', bang(3))), [0, -1, -2] )
+        teq( MonadApply('-', bang(3)), [0, -1, -2] )
+        teq( AdverbMonadApply('/', '*', DyadApply(Num(1), '+', bang(20))), math.factorial(20) )
+        teq( AdverbMonadApply('/', '+', DyadApply(Num(0.5), '*', bang(4))), 3.0 )
+        teq( AdverbMonadApply('\\', '+', bang(4)), [0, 1, 3, 6] )
+
+    # memoization
+    inc = Function(['x'], [DyadApply(Var('x'), '+', Num(1))])
+    memo = memoize(inc, maxsize=2)
+    teq( AdverbMonadApply("'", inc, List(nums(1, 2, 1, 1, 2))), [2, 3, 2, 2, 3] )
+    assert memo.stats()["misses"] == 2 and memo.stats()["hits"] == 3
+    teq( AdverbMonadApply("'", inc, List(nums(3, 4, 1))), [4, 5, 2] ) # 1 was evicted
+    assert memo.stats()["misses"] == 5 and memo.stats()["evictions"] == 3
+    zeros = Function(['x'], [DyadApply(Var('x'), '#', Num(0))])
+    memo = memoize(zeros, maxitems=4)
+    teq( AdverbMonadApply("'", zeros, List(nums(2, 5, 2))), [[0, 0], [0, 0, 0, 0, 0], [0, 0]] )
+    assert memo.stats() == {"hits": 1, "misses": 2, "evictions": 0, "size": 1, "items": 3}
+    try: memoize(Function(['x'], [Assign('a', Var('x'))]))
+    except GeneralError: pass
+    else: assert False, "memoized an impure Function"
+    memoize(Function(['x'], [DyadApply(Function(['a'], [Assign('a', Num(1))]), '@', Var('x'))])) # assigns its own argument
+    add_a = Function(['x'], [DyadApply(Var('x'), '+', Var('a'))])
+    memo = memoize(add_a)
+    bind('a', Num(1))
+    teq( DyadApply(add_a, '@', Num(1)), 2 )
+    bind('a', Num(100))
+    teq( DyadApply(add_a, '@', Num(1)), 101 )
+    teq( DyadApply(add_a, '@', Num(1.0)), 101.0 )
+    assert type(eval(DyadApply(add_a, '@', Num(1.0))).v) is float and memo.stats()["hits"] == 1
+    calls_g = Function(['x'], [DyadApply(Var('g'), '@', Var('x'))])
+    memoize(calls_g)
+    bind('g', Function(['x'], [DyadApply(Var('x'), '*', Var('a'))]))
+    teq( DyadApply(calls_g, '@', Num(2)), 200 )
+    bind('a', Num(3))
+    teq( DyadApply(calls_g, '@', Num(2)), 6 ) # a is read by g
+    teq( DyadApply(calls_g, '@', List(nums(2, 3))), [6, 9] )
+    teq( DyadApply(calls_g, '@', List(nums(2.0, 3))), [6.0, 9] )
+    del default.env[0]['a'], default.env[0]['g']
+    default.memos.clear()
+
+    # converge
+    tail = Function(['x'], [DyadApply(Num(1), '_', Var('x'))])
+    teq( AdverbMonadApply('\\', tail, List(nums(1, 2))), List([List(nums(1, 2)), List(nums(2)), List([])]) )
+    teq( AdverbMonadApply('/', tail, List(nums(1, 2))), [] )
+    assert default.converge_info == {"iterations": 3, "cycle": 1}
+    # 0 -> 1 -> 2 -> 3 -> 1 never returns to the initial 0, nor reaches a fixed point
+    cyc = List(nums(1, 2, 3, 1))
+    step = Function(['x'], [DyadApply(cyc, '.', List([Var('x')]))])
+    teq( AdverbMonadApply('\\', step, Num(0)), [0, 1, 2, 3] )
+    assert default.converge_info == {"iterations": 4, "cycle": 3}
+    default.converge_limit = 2
+    terr( AdverbMonadApply('/', step, Num(0)), GeneralError )
+    assert Interpreter().eval(AdverbMonadApply('/', step, Num(0))) == Num(3) # its own limit
+    default.converge_limit = None
+
+    # profiling
+    sq = Function(['x'], [DyadApply(Var('x'), '*', Var('x'))])
+    sq.name = 'sq'
+    sum_ = Function(['x'], [AdverbMonadApply('/', Verb('+', False), Var('x'))])
+    sum_.pos = (1, 25)
+    with profiling() as p:
+        eval(Assign('sq', sq))
+        eval(AdverbMonadApply("'", Var('sq'), MonadApply('!', Num(5))))
+        eval(AdverbMonadApply("'", sum_, List([List(nums(1, 2)), List(nums(3, 4, 5))])))
+    assert p.stats["sq"][0] == 5 and p.stats["sq'"][0] == 1 and p.stats["*"][0] == 5
+    assert p.stats["{lambda}@1:25"][0] == 2 and p.stats["+/"][:1] == [2] and p.stats["+/"][3:] == [5, 3]
+    assert p.stats["sq'"][1] >= p.stats["sq"][1] >= p.stats["*"][1]
+    assert "sq';sq;* " in p.collapsed() and p.report().splitlines()[0].startswith("verb")
+    assert default.profiler is None
+
+    # grade
+    for xs in [[2, 5, 1, 3], [3, 1, 3, 1, 2], [1, 10**9, -5, 10**9], [2.5, 1, 2.5, -1], []]:
+        up = sorted(range(len(xs)), key=xs.__getitem__)
+        down = sorted(range(len(xs)), key=lambda i: -xs[i])
+        teq( MonadApply('<', to_k(xs)), up )
+        teq( MonadApply('<', List(list(map(Num, xs)))), up )
+        teq( MonadApply('>', to_k(xs)), down )
+        teq( MonadApply('>', List(list(map(Num, xs)))), down )
+    teq( MonadApply('<', List([Char(99), Char(97), Char(98), Char(97)])), [1, 3, 2, 0] )
+    teq( MonadApply('>', List([Char(99), Char(97), Char(98), Char(97)])), [0, 2, 1, 3] )
+    teq( MonadApply('<', to_k([[2, 1], [1, 5], [1, 2]])), [2, 1, 0] )
+
+    # 64 bit overflow gives the same results with NumPy as without
+    big = 2**62
+    teq( DyadApply(List(nums(2, 3)), '*', Num(big)), [2*big, 3*big] )
+    teq( AdverbMonadApply('/', Verb('+', False), List(nums(big, big))), 2*big )
+    teq( AdverbMonadApply('\\', Verb('+', False), List(nums(big, big, -big))), [big, 2*big, big] )
+    teq( DyadApply(MonadApply('!', Num(3)), '+', Num(2**63 - 1)), [2**63 - 1, 2**63, 2**63 + 1] )
+    teq( DyadApply(Num(2**64), '-', MonadApply('!', Num(2))), [2**64, 2**64 - 1] )
+    teq( MonadApply('-', List(nums(-2**63, 1))), [2**63, -1] )
+    teq( MonadApply('-', DyadApply(MonadApply('!', Num(2)), '-', Num(2**63))), [2**63, 2**63 - 1] )
+    teq( DyadApply(List(nums(big, 1)), '-', List(nums(-big, 1))), [2*big, 0] )
+    huge = List(nums(1, 2)) # joins that don't fit one int64 or float64 array stay boxed
+    teq( AdverbMonadApply('/', Verb('+', False), DyadApply(huge, ',', Num(2**70))), 3 + 2**70 )
+    teq( DyadApply(DyadApply(huge, ',', Num(2**70)), '+', Num(1)), [2, 3, 2**70 + 1] )
+    teq( DyadApply(Num(0.5), ',', Num(2**53 + 1)), List([Num(0.5), Num(2**53 + 1)]) )
+    mixed = eval(DyadApply(huge, ',', Num(3.5)))
+    assert [type(item(mixed, i).v) for i in range(3)] == [int, int, float] and is_(mixed, List) and not is_(mixed, Vec)
+    assert type(item(to_k([2, 3.5]), 0).v) is int and type(item(eval(DyadApply(Num(0.5), ',', MonadApply('!', Num(4)))), 1).v) is int
+    teq( Fused(DyadApply(Var('0'), '*', Var('0')), [List(nums(2**40, 3))]), [2**80, 9] )
+    teq( Fused(DyadApply(DyadApply(Var('0'), '*', Var('0')), '-', Num(2**80)), [List(nums(2**40, 3))]), [0, 9 - 2**80] )
+
+    # strings
+    cab = eval(List([Char(99), Char(97), Char(98)]))
+    assert is_(cab, Str) and cab.s == "cab" and cab == List([Char(99), Char(97), Char(98)]) and hash(cab) == hash(List(cab.v))
+    teq( DyadApply(cab, '.', List([MonadApply('<', cab)])), text("abc") )
+    teq( DyadApply(cab, '.', List([MonadApply('>', cab)])), text("cba") )
+    teq( MonadApply('*', DyadApply(Num(1), '_', cab)), Char(97) )
+    teq( DyadApply(Num(5), '#', cab), text("cabca") )
+    teq( DyadApply(Num(3), '#', Char(120)), text("xxx") )
+    teq( DyadApply(List(nums(2, 2)), '#', cab), List([text("ca"), text("bc")]) )
+    teq( MonadApply('<', DyadApply(List(nums(3, 2)), '#', text("baab"))), [1, 0, 2] )
+    teq( AdverbMonadApply("'", Function(['x'], [Var('x')]), cab), text("cab") )
+    assert is_(eval(DyadApply(List(nums(2, 2)), '#', cab)), Array) and footprint(cab) == 3
+
     # adverbs
+    teq( AdverbMonadApply('/', '+', List(nums(1, 2, 3))), 6 )
+    teq( AdverbMonadApply('/', '+', List([])), 0 )
+    teq( AdverbMonadApply('/', '*', List([])), 1 )
+    teq( AdverbMonadApply('/', '+', matrix), [4, 6] ) # sum of rows
+    teq( AdverbMonadApply('\\', '+', List(nums(1, 2, 3))), [1, 3, 6] )
+    teq( AdverbMonadApply('\\', '+', to_k([1, 2, 3])), [1, 3, 6] )
+    teq( AdverbMonadApply('\\', '*', to_k([1, 2, 3, 4])), [1, 2, 6, 24] )
+    teq( AdverbMonadApply('\\', '+', matrix), [[1, 2], [4, 6]] )
+    teq( AdverbMonadApply("'", Verb('-', True), to_k([1, 2])), [-1, -2] )
+    teq( AdverbMonadApply("'", Verb('#', True), matrix), [2, 2] )
+    teq( AdverbMonadApply('/', Function(['x', 'y'], [DyadApply(Var('x'), '-', Var('y'))]), List(nums(10, 2, 3))), 5 )
+
+    # files
+    import tempfile, os
+    with tempfile.TemporaryDirectory() as d:
+        col, txt, empty = text(os.path.join(d, "col")), text(os.path.join(d, "txt")), text(os.path.join(d, "empty"))
+        teq( DyadApply(Num(1), ':', List([col, to_k([3, 1, 2, -5])])), col )
+        teq( DyadApply(Num(1), ':', col), [3, 1, 2, -5] )
+        teq( MonadApply('<', DyadApply(Num(1), ':', col)), [3, 1, 2, 0] )
+        teq( AdverbMonadApply('/', '+', DyadApply(Num(2), '_', DyadApply(Num(1), ':', col))), -3 )
+        teq( DyadApply(DyadApply(Num(1), ':', col), '*', Num(2)), [6, 2, 4, -10] )
+        with open(os.path.join(d, "col"), "wb") as f: f.write(array.array("i", [7, 8]).tobytes())
+        teq( DyadApply(Num(1), ':', List([col, Char(ord("i"))])), [7, 8] )
+        with open(os.path.join(d, "col"), "wb") as f: f.write(array.array("h", [30000, 2]).tobytes())
+        shorts = DyadApply(Num(1), ':', List([col, Char(ord("h"))]))
+        teq( DyadApply(shorts, '+', shorts), [60000, 4] ) # not wrapped at 16 bits
+        teq( DyadApply(shorts, '*', Num(10**6)), [3 * 10**10, 2 * 10**6] )
+        teq( AdverbMonadApply('\\', '+', DyadApply(Num(3), '#', shorts)), [30000, 30002, 60002] )
+        teq( Fused(DyadApply(Var('0'), '-', DyadApply(Num(0), '-', Var('0'))), [shorts]), [60000, 4] )
+        write_file(os.path.join(d, "col"), bytes([0, 1]))
+        teq( DyadApply(DyadApply(Num(1), ':', List([col, Char(ord("x"))])), '-', Num(1)), [-1, 0] )
+        write_file(os.path.join(d, "col"), array.array("f", [0.1]).tobytes())
+        assert eval(DyadApply(DyadApply(Num(1), ':', List([col, Char(ord("e"))])), '*', Num(1.0))) == List([Num(array.array("f", [0.1])[0])]) # widened exactly, not rounded again
+        with open(os.path.join(d, "col"), "wb") as f: f.write(b"12345")
+        terr( DyadApply(Num(1), ':', col), LengthError )
+        teq( DyadApply(Num(0), ':', List([txt, List([text("ab"), text("cde"), List([])])])), txt )
+        lines = eval(DyadApply(Num(0), ':', txt))
+        assert is_(lines, Lines) and count(lines) == 3 and item(lines, 1) == text("cde") and item(lines, -1) == List([])
+        assert lines == List([text("ab"), text("cde"), List([])])
+        teq( MonadApply('#', DyadApply(Num(1), '_', DyadApply(Num(0), ':', txt))), 2 )
+        teq( DyadApply(Num(1), ':', List([txt, Char(ord("c"))])), text("ab\ncde\n\n") )
+        write_file(os.path.join(d, "empty"), b"")
+        teq( DyadApply(Num(0), ':', empty), [] )
+        teq( DyadApply(Num(1), ':', empty), [] )
+
+    # buffers
+    samples = array.array("i", [5, -1, 3])
+    x = to_k(samples)
+    teq( DyadApply(x, '+', Num(1)), [6, 0, 4] )
+    teq( MonadApply('<', x), [1, 2, 0] )
+    out = as_buffer(x)
+    assert out.format == "i" and out.readonly and out.tolist() == [5, -1, 3]
+    samples[0] = 7 # shared, not copied
+    assert from_k(x) == [7, -1, 3] and out[0] == 7 and from_k(from_buffer(samples, copy=True)) == [7, -1, 3]
+    s = to_k(b"cab")
+    teq( s, text("cab") )
+    teq( DyadApply(Num(1), '_', s), text("ab") )
+    assert as_buffer(op_underscore(Num(1), s)).tobytes() == b"ab"
+    assert as_buffer(text("hi")).format == "c" and as_buffer(text("hi")).tobytes() == b"hi"
+    m = as_buffer(matrix)
+    assert m.shape == (2, 2) and m.tolist() == [[1, 2], [3, 4]] and to_k(m) == matrix
+    assert as_buffer(List([Num(1.5), Num(2)])).tolist() == [1.5, 2.0] and as_buffer(List([])).tolist() == []
+    assert to_k(memoryview(array.array("d", [2.5])).cast("B").cast("d", [])) == Num(2.5)
+    inc = Function(['x'], [DyadApply(Var('x'), '+', Num(1))])
+    assert as_buffer(apply_fn(inc, [to_k(array.array("d", [0.5, 1]))])).tolist() == [1.5, 2.0]
+    for bad in [ragged, List([Num(1), Char(97)])]:
+        try: as_buffer(bad)
+        except TypeError: pass
+        else: assert False, "as_buffer took %r" % bad
+    try: to_k("str")
+    except InternalError: pass
+    else: assert False, "to_k took a str"
+    bs = to_k(array.array("b", [100, 50]))
+    teq( DyadApply(bs, '+', bs), [200, 100] )
+    teq( DyadApply(to_k(array.array("B", [0, 1])), '-', Num(1)), [-1, 0] )
+    teq( MonadApply('-', to_k(array.array("b", [-128]))), [128] )
+    teq( AdverbMonadApply('/', '+', to_k(array.array("B", [255, 255]))), 510 )
+    teq( DyadApply(to_k(array.array("Q", [2**64 - 1])), '+', Num(1)), [2**64] )
+    assert as_buffer(bs).format == "b" and as_buffer(eval(DyadApply(bs, '+', bs))).tolist() == [200, 100]
+    if np is not None:
+        grid = to_k(np.array([[100, 100], [1, 2]], dtype=np.int8))
+        teq( DyadApply(grid, '+', grid), [[200, 200], [2, 4]] )
+
+    # views
+    teq( DyadApply(List(nums(1, 2)), ',', Num(3)), [1, 2, 3] )
+    teq( DyadApply(Num(1), ',', List([Char(97), Num(2)])), List([Num(1), Char(97), Num(2)]) )
+    teq( DyadApply(Str("ab"), ',', Char(99)), Str("abc") )
+    views = Interpreter()
+    total = AdverbMonadApply('/', Verb('+', False), Var('v'))
+    views.eval(Assign('v', List(nums(1, 2, 3))))
+    assert views.eval(Depend('t', total)) == List([])
+    views.eval(Depend('u', DyadApply(Var('t'), '*', Num(2))))
+    views.eval(Depend('n', MonadApply('#', Var('v'))))
+    assert views.eval(Var('u')) == Num(12) and views.eval(Var('u')) == Num(12) and views.eval(Var('n')) == Num(3)
+    views.eval(Assign('v', DyadApply(Var('v'), ',', List(nums(4, 5)))))
+    views.eval(Assign('v', DyadApply(Var('v'), ',', Num(6))))
+    assert views.eval(Var('u')) == Num(42) and views.eval(Var('n')) == Num(6)
+    assert views.call(view_stats) == {"t": {"hits": 4, "recomputes": 1, "increments": 2}, # u looks t up too
+                                      "u": {"hits": 1, "recomputes": 2, "increments": 0},
+                                      "n": {"hits": 1, "recomputes": 1, "increments": 2}}
+    views.eval(Assign('v', List(nums(10, 20)))) # not an append
+    assert views.eval(Var('t')) == Num(30) and views.call(view_stats)["t"]["recomputes"] == 2
+    views.eval(Assign('t', Num(1))) # no longer a view
+    assert views.eval(Var('u')) == Num(2) and views.env.watch == {"v": [views.env[0]['n']]}
+    views.eval(Assign('v', DyadApply(Var('v'), ',', Char(97))))
+    assert views.eval(Var('n')) == Num(3)
+    views.eval(Depend('c', DyadApply(Var('c'), '+', Num(1))))
+    try: views.eval(Var('c'))
+    except GeneralError: pass
+    else: assert False, "circular view"
+    assert lookup('t') is None
+    views.eval(Assign('g', Num(1)))
+    views.eval(Assign('f', Function(['x'], [DyadApply(Var('x'), '+', Var('g'))])))
+    views.eval(Depend('w', DyadApply(Var('f'), '@', Num(1))))
+    assert views.eval(Var('w')) == Num(2)
+    views.eval(Assign('g', Num(100))) # w only uses f, but f uses g
+    assert views.eval(Var('w')) == Num(101) and views.eval(Var('w')) == Num(101)
+    views.eval(DyadApply(Var('v'), ',', Num(7))) # not assigned, so nothing is kept
+    assert _current.joined is None and not _current.joining
+
+    # interpreters
+    a, b = Interpreter(), Interpreter()
+    a.eval(Assign('v', Num(1)))
+    b.eval(Assign('v', Num(2)))
+    assert a.eval(Var('v')) == Num(1) and b.eval(Var('v')) == Num(2) and lookup('v') is None
+    total = Function(['x'], [Assign('s', Num(0)), AdverbMonadApply("'", Function(['y'], [Assign('s', DyadApply(Var('s'), '+', Var('y')))]), Var('x')), Var('s')])
+    results = {}
+    def run(i, interp):
+        interp.eval(Assign('f', total))
+        results[i] = [interp.eval(DyadApply(Var('f'), '@', MonadApply('!', Num(200 + i)))) for _ in range(20)]
+    threads = [threading.Thread(target=run, args=(i, Interpreter())) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert all(results[i] == [Num(sum(range(200 + i)))] * 20 for i in range(4))
+    try: a.eval(DyadApply(Function(['x'], [Var('nope')]), '@', Num(1)))
+    except BindingError: pass
+    assert len(a.env) == 1 # the failed call's scope was popped
+    p = a.call(start_profiler)
+    a.call(memoize, inc)
+    a.eval(DyadApply(inc, '@', Num(1)))
+    b.eval(DyadApply(inc, '@', Num(1)))
+    assert a.call(stop_profiler) is p and p.stats[fn_label(inc)][0] == 1 and default.profiler is b.profiler is None
+    assert a.memos[inc].stats()["misses"] == 1 and not b.memos and not default.memos
 
-    print("%d tests succeeded, %d tests failed" % (_testsSucceeded, _testsFailed))
+    print("%d tests succeeded, %d tests failed" % (default.tests_succeeded, default.tests_failed))
 
 def main():
-    tests()
+    import sys
+    if sys.argv[1:] == ["mem"]: node_memory()
+    else: tests()
 
 if __name__ == "__main__": main()
\ No newline at end of file
@@ -0,0 +1,29 @@
+// A long-lived oK <https://github.com/JohnEarnest/ok> worker for compare.py.
+//
+// Reads one JSON request per line on stdin: {"id": n, "exprs": ["1+2", ...]}
+// and writes one JSON line per expression, in order, as soon as it is done:
+// {"id": n, "i": index, "ast": <oK parse tree>, "value": <oK result>}
+// with "error" set instead of "ast"/"value" if parsing or evaluation failed.
+
+var path = require('path');
+var readline = require('readline');
+var ok = require(path.resolve(process.env.OK_PATH || '../ok/ok'));
+
+function answer(id, i, expr) {
+	var r = {id: id, i: i};
+	try {
+		var tree = ok.parse(expr);
+		r.ast = tree;
+		r.value = ok.run(tree, ok.baseEnv());
+	}
+	catch (e) { r.error = String(e); }
+	try { return JSON.stringify(r); }
+	catch (e) { return JSON.stringify({id: id, i: i, error: "unserializable result: " + e}); }
+}
+
+readline.createInterface({input: process.stdin, terminal: false}).on('line', function(line) {
+	var req = JSON.parse(line);
+	for (var i = 0; i < req.exprs.length; i++) {
+		process.stdout.write(answer(req.id, i, req.exprs[i]) + "\n");
+	}
+});
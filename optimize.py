@@ -0,0 +1,274 @@
+# Rewrite k node trees into equivalent, cheaper ones before they are compiled.
+#
+# Three rewrites, in this order:
+#   folding   applies built-in verbs to constants ahead of time: 1+2 becomes 3, and -1 2 3 a Const
+#   hoisting  computes the parts of a Function applied under an adverb that don't depend on its
+#             arguments once per loop: {x*+/a}'v runs +/a once, not once per item, and not at
+#             all if v is empty
+#   fusion    runs chains of +, - and * as one Fused kernel with no intermediate lists, and
+#             turns {x*2+x}'v into such a kernel on v
+#
+# compiler.run and compiler.eval optimize unless enabled is False. k.eval runs trees as they are,
+# and stays the reference that tests() checks every rewrite against. Memoized Functions are left
+# as they are, and so is everything while the current Interpreter is profiling, so that their
+# Memos and profiles still see the Functions and verbs that were written.
+
+import contextlib, itertools
+import k, parse
+from k import is_, Node, Num, Char, Str, Vec, List, DyadApply, MonadApply, AdverbMonadApply, AdverbDyadApply, Function, Var, Assign, Const, Fused, Depend, Delay, Force
+
+enabled = True
+FOLD_LIMIT = 1024 # don't fold ! or # into results of more items than this
+
+def optimize(expr):
+    "Returns a tree that evaluates like expr, or expr itself while the current Interpreter is profiling."
+    if k.current().profiler is not None: return expr
+    return fuse(hoist(fold(expr)))
+
+@contextlib.contextmanager
+def disabled():
+    "with disabled(): ... compiles the block without optimizing."
+    global enabled
+    was, enabled = enabled, False
+    try: yield
+    finally: enabled = was
+
+def kept(fn):
+    "Must the Function fn stay as it is, because it is memoized or there is a profiler?"
+    interp = k.current()
+    return interp.profiler is not None or fn in interp.memos
+
+def rebuild(expr, f):
+    "Returns expr with f applied to each node directly under it. A kept Function is returned as it is."
+    op = lambda op: f(op) if is_(op, Node) else op
+    if is_(expr, DyadApply): return DyadApply(f(expr.l), op(expr.op), f(expr.r))
+    if is_(expr, MonadApply): return MonadApply(op(expr.op), f(expr.v))
+    if is_(expr, AdverbMonadApply): return AdverbMonadApply(expr.adv, op(expr.op), f(expr.v))
+    if is_(expr, AdverbDyadApply): return AdverbDyadApply(expr.adv, f(expr.l), op(expr.op), f(expr.r))
+    if is_(expr, Function): return expr if kept(expr) else like(expr, expr.args, [f(e) for e in expr.body])
+    if is_(expr, Assign): return Assign(expr.name, f(expr.v))
+    if is_(expr, Depend): return Depend(expr.name, f(expr.v))
+    if is_(expr, Delay): return Delay(f(expr.v))
+    if is_(expr, Force): return Force(f(expr.v))
+    if is_(expr, Fused): return Fused(expr.tree, [f(a) for a in expr.args])
+    if type(expr) is List: return List([f(e) for e in expr.v])
+    return expr
+
+def like(fn, args, body):
+    "A Function with args and body, keeping the name and position of fn for profiles."
+    r = Function(args, body)
+    for attr in ("name", "pos"):
+        if hasattr(fn, attr): setattr(r, attr, getattr(fn, attr))
+    return r
+
+def is_const(expr):
+    "Is expr a value, which evaluates to itself?"
+    return is_(expr, Num) or is_(expr, Char) or is_(expr, Str) or is_(expr, Vec) or is_(expr, Const)
+
+def value(expr): return expr.v if is_(expr, Const) else expr
+
+def const(v):
+    "The node for the value v."
+    return v if is_(v, Num) or is_(v, Char) or is_(v, Str) or is_(v, Vec) else Const(v)
+
+# Folding
+
+FOLD_DYADS = {"+", "-", "*", "#", "_", "."}
+FOLD_MONADS = {"#", ",", "!", "-", "*", "<", ">"}
+
+def small(op, args):
+    "Would applying the verb op to the values args give at most FOLD_LIMIT items?"
+    if op == "!": return is_(args[0], Num) and args[0].v <= FOLD_LIMIT
+    if op == "#" and len(args) == 2:
+        n = args[0]
+        if is_(n, Num): return n.v <= FOLD_LIMIT
+        dims = k.flat_values(n) if is_(n, List) else None
+        return dims is not None and k.product(dims) <= FOLD_LIMIT
+    return True
+
+def try_fold(expr, op, args):
+    "Evaluates expr, whose args are constant, if it is small and doesn't fail. Failures are left for run time."
+    if not small(op, [value(a) for a in args]): return expr
+    try: return const(k.eval(expr))
+    except Exception: return expr
+
+def fold(expr):
+    expr = rebuild(expr, fold)
+    if type(expr) is List and all(map(is_const, expr.v)): return try_fold(expr, None, [])
+    if is_(expr, DyadApply) and type(expr.op) is str and expr.op in FOLD_DYADS and is_const(expr.l) and is_const(expr.r):
+        return try_fold(expr, expr.op, [expr.l, expr.r])
+    if is_(expr, MonadApply) and type(expr.op) is str and expr.op in FOLD_MONADS and is_const(expr.v):
+        return try_fold(expr, expr.op, [expr.v])
+    if is_(expr, AdverbMonadApply) and not is_(expr.op, Function) and not is_(expr.op, Var) and is_const(expr.v):
+        name = k.verb_name(expr.op)
+        if name not in ("!", "#", ":"): return try_fold(expr, name, [expr.v])
+    return expr
+
+# Hoisting
+
+def calls(expr):
+    "Could evaluating expr call a Function that isn't written out in it, or touch a file?"
+    if is_(expr, Function): return any(map(calls, expr.body))
+    if is_(expr, DyadApply):
+        if is_(expr.op, Var) or expr.op == ":": return True
+        if expr.op in ("@", ".") and not is_(expr.l, Function) and not is_const(expr.l) and type(expr.l) is not List: return True
+    if is_(expr, MonadApply) and is_(expr.op, Var): return True
+    if (is_(expr, AdverbMonadApply) or is_(expr, AdverbDyadApply)) and is_(expr.op, Var): return True
+    return any(map(calls, k.children(expr)))
+
+def names(expr):
+    "The names expr uses or assigns, inside Functions too."
+    r, todo = set(), [expr]
+    while todo:
+        e = todo.pop()
+        if is_(e, Var) or is_(e, Assign) or is_(e, Depend): r.add(e.name)
+        if is_(e, Function): r.update(e.args)
+        todo.extend(k.children(e))
+    return r
+
+def assigns(expr):
+    "The names assigned anywhere in expr, inside Functions too."
+    r, todo = set(), [expr]
+    while todo:
+        e = todo.pop()
+        if is_(e, Assign) or is_(e, Depend): r.add(e.name)
+        todo.extend(k.children(e))
+    return r
+
+def invariants(fn):
+    """Returns the largest subexpressions of the body of fn that don't depend on anything fn or the
+    loop can change: they use no argument of fn and no assigned name, call nothing and assign
+    nothing. Nested Functions are left alone, since their bodies only run if they are called."""
+    if any(map(calls, fn.body)): return []
+    varying = set(fn.args) | assigns(fn)
+    found = []
+    def visit(e):
+        if is_(e, Function): return
+        if (is_(e, DyadApply) or is_(e, MonadApply) or is_(e, AdverbMonadApply)) and not names(e) & varying:
+            if e not in found: found.append(e)
+            return
+        for c in k.children(e): visit(c)
+    for e in fn.body: visit(e)
+    return found
+
+_fresh = itertools.count()
+
+def replace(expr, old, new):
+    "Replaces each subexpression of expr equal to old with new, outside nested Functions."
+    if expr == old: return new
+    if is_(expr, Function): return expr
+    return rebuild(expr, lambda e: replace(e, old, new))
+
+def hoist(expr):
+    """Rewrites f'v, f/v and f\\v for a Function f with invariant subexpressions e0, e1... into
+    {[`v] {[`h0] {[`h1] ... f'`v} Delay(e1)} Delay(e0)} v, with each ei in f replaced by
+    Force(`hi). So each ei is evaluated the first time f needs it, in the scope it was in, and
+    then never again in that loop, nor at all if the adverb doesn't call f. The names can't
+    clash with K's."""
+    expr = rebuild(expr, hoist)
+    if not is_(expr, AdverbMonadApply) or not is_(expr.op, Function) or kept(expr.op): return expr
+    found = invariants(expr.op)
+    if not found: return expr
+    i = next(_fresh)
+    body, holes = expr.op.body, []
+    for j, e in enumerate(found):
+        holes.append("`h%d_%d" % (i, j))
+        body = [replace(b, e, Force(Var(holes[-1]))) for b in body]
+    loop = AdverbMonadApply(expr.adv, like(expr.op, expr.op.args, body), Var("`v%d" % i))
+    for hole, e in reversed(list(zip(holes, found))):
+        loop = DyadApply(Function([hole], [loop]), "@", Delay(e))
+    return DyadApply(Function(["`v%d" % i], [loop]), "@", expr.v)
+
+# Fusion
+
+def fusible(expr):
+    if is_(expr, DyadApply): return type(expr.op) is str and expr.op in k.FUSIBLE_DYADS
+    if is_(expr, MonadApply): return type(expr.op) is str and expr.op in k.FUSIBLE_MONADS
+    return False
+
+def chain(expr, leaves):
+    "Returns the Fused tree of the fusible chain at expr, adding the subexpressions it takes as inputs to leaves."
+    if fusible(expr):
+        if is_(expr, MonadApply): return MonadApply(expr.op, chain(expr.v, leaves))
+        l = chain(expr.l, leaves) # left first, the order eval evaluates them in
+        return DyadApply(l, expr.op, chain(expr.r, leaves))
+    if is_(expr, Num): return expr
+    if expr not in leaves: leaves.append(expr)
+    return Var(str(leaves.index(expr)))
+
+def ops(tree): return 0 if not fusible(tree) else 1 + sum(ops(c) for c in k.children(tree) if is_(c, Node))
+
+def pure(expr): return not calls(expr) and not assigns(expr)
+
+def each_kernel(expr):
+    """Returns {E}'v as a Fused node running E on v, if E is a chain over the argument and Num atoms.
+    Being atomic, the chain gives the same items on the whole of v as on each item."""
+    fn = expr.op
+    if expr.adv != "'" or not is_(fn, Function) or len(fn.args) != 1 or len(fn.body) != 1 or kept(fn): return None
+    leaves = []
+    tree = chain(fn.body[0], leaves)
+    if leaves != [Var(fn.args[0])]: return None
+    return Fused(tree, [expr.v])
+
+def fuse(expr):
+    if is_(expr, AdverbMonadApply):
+        f = each_kernel(expr)
+        if f is not None: return Fused(f.tree, [fuse(a) for a in f.args])
+    if fusible(expr):
+        leaves = []
+        tree = chain(expr, leaves)
+        # leaves are evaluated before any verb of the chain runs, so they must not have side
+        # effects that an error in the chain would have prevented
+        if ops(tree) >= 2 and all(map(pure, leaves)): return Fused(tree, [fuse(l) for l in leaves])
+    return rebuild(expr, fuse)
+
+def tests():
+    import compiler
+    srcs = ["1+2", "-(1 2 3)", "{x+1+2}' 1 2 3", "2 3 # !6", "+/1+!10", "{x*2}' 1 2 3", "{x*x-1}' 1 2.5 3",
+            "a: 1 2 3; b: 4 5 6; a+b*a-3", "a: 10; {x*a+a}' 1 2 3", "a: 2 3; {x+#a}' 1 2", "{x+-y}/ 1 2 3",
+            "{x*2}' (1 2; 3 4)", "a: 4; {x+y*a*2}\\ 1 2 3", "{[n] {x+n*n}' 1 2} 3", "{x+1}' ()", "(!3)+(!3)*2",
+            "a: 1; {a: x; a+1}' 5 6", "{x[(#x)-1]}' (1 2; 3 4 5)", "{x*1 2}' 3 4", "1 2 + 1 2 3", "{a: x}' 1 2; a",
+            '{x[<x]} "hello"', "b: 5; {y*b+1}/ 1 2 3", "(1.5+2)*!4", "x: 3; -x+x*x", "{x*+/a}' ()",
+            "a: 3; {x*+/a}' ()", "{x+y*+/a}/ ,5", "a: 1 2; {x*+/a}' 1 2; a: 3 4; {x*+/a}' 1 2",
+            '(!1)*2*"baac"', '(!5)*--"abc"', "(1 2)*3*1 2 3", '1*2+"ab"']
+    for src in srcs:
+        exprs = parse.parse(src)
+        k.default.reset()
+        try: expected = [k.eval(e) for e in exprs][-1]
+        except Exception as e: expected = e
+        k.default.reset()
+        for e in exprs[:-1]: k.eval(optimize(e))
+        if isinstance(expected, Exception): k.terr(optimize(exprs[-1]), type(expected))
+        else: k.teq(optimize(exprs[-1]), expected)
+        k.default.reset()
+        if not isinstance(expected, Exception): k.teq(Const(compiler.run(src)), expected)
+    first = lambda src: optimize(parse.parse(src)[0])
+    assert first("1+2") == Num(3) and first("{x+1+2}").body == [DyadApply(Var("x"), "+", Num(3))]
+    assert is_(first("{x*2}' v"), Fused) and is_(first("a+b*c-1"), Fused) and not is_(first("a+1"), Fused)
+    assert not is_(first("(a: 1)+b*c"), Fused) # its leaves have side effects
+    hoisted = first("{x*+/a}' v")
+    assert is_(hoisted, DyadApply) and hoisted.l.args[0].startswith("`v") and hoisted.r == Var("v")
+    assert is_(hoisted.l.body[0].r, Delay) and is_(hoisted.l.body[0].r.v, AdverbMonadApply) # +/a, computed once
+    assert is_(first("{a: x; x*+/a}' v"), AdverbMonadApply) and is_(first("{f x; x*+/a}' v"), AdverbMonadApply)
+    assert is_(first("!100000"), MonadApply) # too big to fold
+    k.memoize(parse.parse("{x*+/a}")[0])
+    assert is_(first("{x*+/a}' v"), AdverbMonadApply) and is_(first("{x+1}' v"), Fused)
+    k.memoize(parse.parse("{x*2}")[0])
+    assert is_(first("{x*2}' v"), AdverbMonadApply)
+    k.default.memos.clear()
+    with k.profiling(): assert not is_(first("{x*2}' v"), Fused) and not is_(first("a+b*c-1"), Fused) and first("1+2") != Num(3)
+    k.memoize(parse.parse("{x+1+2}")[0])
+    assert first("{x+1+2}' v").op == parse.parse("{x+1+2}")[0] and first("{y; {x+1+2}' v}").body[1].op == parse.parse("{x+1+2}")[0]
+    stats = []
+    for off in (disabled(), contextlib.nullcontext()): # the Memo sees the same calls either way
+        with off:
+            k.default.memos[parse.parse("{x+1+2}")[0]] = memo = k.Memo()
+            assert compiler.run("{x+1+2}' 1 1 1") == k.to_k([4, 4, 4])
+            stats.append(memo.stats())
+    assert stats[0] == stats[1] and stats[0]["hits"] == 2, stats
+    k.default.memos.clear()
+    with disabled(): assert compiler.run("{x*2}' 1 2") == k.to_k([2, 4]) and not enabled
+    assert enabled
+    print("optimize tests: %d succeeded, %d failed" % (k.default.tests_succeeded, k.default.tests_failed))
+
+if __name__ == "__main__": tests()
@@ -0,0 +1,241 @@
+# Run f'x, and f/x and f\x for associative built-ins, on a pool of worker processes.
+#
+#   import parallel
+#   with parallel.pool(workers=8, threshold=10000): k.eval(...)
+#
+# While a Pool is installed as k.parallel, run_adverb offers it every each, over and scan that
+# no kernel handled. Lists with at least threshold items are cut into chunks that the workers
+# take in turn; the results come back in order. The op and the values of the names it uses are
+# pickled once per call and sent to each worker once, however many chunks it runs. Anything the
+# pool can't run (smaller lists, Functions with side effects, values that can't be pickled) is
+# left to the serial loop.
+
+import collections, contextlib, hashlib, multiprocessing, multiprocessing.connection, os, pickle, sys, time
+import k, parse
+from k import is_, Num, List, Vec, Var, Function
+
+ASSOCIATIVE = {"+": Num(0), "*": Num(1)} # built-in dyads whose over and scan can be split, with their identities
+
+def worker_main(conn):
+    "Runs in each worker: keeps the jobs it's sent and runs chunks of them."
+    jobs = collections.OrderedDict() # key -> (kind, op, bindings), the most recent last
+    while True:
+        try: msg = conn.recv()
+        except EOFError: return
+        if msg[0] == "job":
+            _, key, data = msg
+            jobs[key] = pickle.loads(data)
+            while len(jobs) > 16: jobs.popitem(last=False)
+            continue
+        _, key, i, chunk, carry = msg
+        try:
+            kind, op, bindings = jobs[key]
+            interp = k.Interpreter()
+            interp.env[0].update(bindings)
+            r = ("ok", i, interp.call(run_chunk, kind, op, chunk, carry))
+        except Exception as e:
+            r = ("error", i, e)
+        try: conn.send(r)
+        except Exception as e: conn.send(("error", i, k.GeneralError("%s: %s" % (type(e).__name__, e)))) # unpicklable
+
+def run_chunk(kind, op, chunk, carry):
+    if kind == "'":
+        f = k.as_monad(op)
+        return [f(x) for x in chunk.v]
+    f = k.as_dyad(op)
+    if kind == "/": return k.fold(lambda x, acc: f(acc, x), chunk, carry)
+    return k.scan(lambda x, acc: f(acc, x), chunk, carry).v
+
+def variables(fn):
+    "The names of the variables fn uses, other than its arguments, including those of Functions inside it."
+    names, todo = set(), list(fn.body)
+    while todo:
+        expr = todo.pop()
+        if is_(expr, Var): names.add(expr.name)
+        todo.extend(k.children(expr))
+    return names - set(fn.args)
+
+def captured(op, bindings=None):
+    """Returns op as a plain Function or verb, and adds the values of the variables it uses to
+    bindings. A compiled Lambda's come from the frames it closes over, other Functions' from the
+    current env."""
+    if bindings is None: bindings = {}
+    if not is_(op, Function): return op, bindings
+    fn = op.template.fn if callable(op) else op
+    for name in variables(fn):
+        if name in bindings: continue
+        v = k.force(k.free_value(op, name)) # an invariant hoisted out of the loop, see optimize.hoist
+        if v is None: continue # unbound, which the worker will report if it matters
+        bindings[name] = None # so a Function using itself doesn't loop
+        bindings[name], _ = captured(v, bindings)
+    return fn, bindings
+
+def chunk(xs, lo, hi):
+    return Vec(xs.a[lo:hi]) if is_(xs, Vec) else List(xs.v[lo:hi])
+
+class Worker:
+    def __init__(self, ctx):
+        self.conn, child = ctx.Pipe()
+        self.proc = ctx.Process(target=worker_main, args=(child,), daemon=True)
+        self.proc.start()
+        child.close()
+        self.jobs = set() # keys of the jobs this worker has been sent
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+class Pool:
+    """Worker processes for the adverbs of k.parallel. Lists shorter than threshold run serially,
+    and each list is cut into about chunks_per_worker chunks per worker, to even out uneven items."""
+    def __init__(self, workers=None, threshold=10000, chunks_per_worker=4):
+        self.threshold = threshold
+        self.chunks_per_worker = chunks_per_worker
+        self.ctx = multiprocessing.get_context("spawn") # a fork would copy the caller's threads and locks
+        self.workers = [Worker(self.ctx) for _ in range(workers or os.cpu_count() or 1)]
+        self.stats = collections.Counter() # calls, chunks, jobs sent, serial fallbacks and restarts
+
+    def close(self):
+        for w in self.workers: w.stop()
+        self.workers = []
+
+    def adverb(self, adv, op, xs):
+        "Runs adv with op over xs on the workers, or returns None to leave it to the serial loop."
+        if not self.workers or k.count(xs) < self.threshold: return None
+        if adv in ("/", "\\") and (is_(op, Function) or k.verb_name(op) not in ASSOCIATIVE): return None
+        fn, bindings = captured(op)
+        if any(is_(f, Function) and k.impure_assigns(f) for f in [fn, *bindings.values()]):
+            return None # their assignments would happen in the workers, not here
+        try: data = pickle.dumps((adv, fn, bindings), pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self.stats["serial"] += 1
+            return None
+        n = k.count(xs)
+        size = -(-n // (len(self.workers) * self.chunks_per_worker))
+        chunks = [chunk(xs, lo, min(n, lo + size)) for lo in range(0, n, size)]
+        self.stats["calls"] += 1
+        if adv == "'":
+            results = self.map(data, chunks, [None] * len(chunks))
+            return None if results is None else k.pack([y for ys in results for y in ys])
+        # over folds each chunk, then the partial results. scan needs the partial results too,
+        # to know what each chunk's scan starts from.
+        identity = ASSOCIATIVE[k.verb_name(op)]
+        over = data if adv == "/" else pickle.dumps(("/", fn, bindings), pickle.HIGHEST_PROTOCOL)
+        partials = self.map(over, chunks, [identity] * len(chunks))
+        if partials is None: return None
+        f = k.as_dyad(op)
+        if adv == "/": return k.fold(lambda x, acc: f(acc, x), List(partials), identity)
+        carries = [identity]
+        for p in partials[:-1]: carries.append(f(carries[-1], p))
+        results = self.map(data, chunks, carries)
+        return None if results is None else List([y for ys in results for y in ys])
+
+    def map(self, data, chunks, carries):
+        """Runs the job pickled in data on each chunk, returning the results in order. If a worker
+        has died, it is replaced and None is returned, for the serial loop to run it all instead."""
+        key = hashlib.sha1(data).hexdigest()
+        results, todo, busy, dead = [None] * len(chunks), collections.deque(range(len(chunks))), {}, []
+        def give(w):
+            try:
+                if key not in w.jobs:
+                    w.conn.send(("job", key, data))
+                    w.jobs.add(key)
+                    self.stats["jobs sent"] += 1
+                i = todo.popleft()
+                w.conn.send(("chunk", key, i, chunks[i], carries[i]))
+                busy[w.conn] = w
+            except OSError: dead.append(w)
+        for w in self.workers:
+            if todo: give(w)
+        error = None
+        while busy: # the others are waited for even after a failure, so that no answer is left in a pipe
+            for conn in multiprocessing.connection.wait(list(busy)):
+                w = busy.pop(conn)
+                try: status, i, r = conn.recv()
+                except (EOFError, OSError):
+                    dead.append(w)
+                    continue
+                self.stats["chunks"] += 1
+                if status == "error": error = error or r
+                else: results[i] = r
+                if todo and error is None and not dead: give(w)
+        if dead:
+            self.restart(dead)
+            self.stats["serial"] += 1
+            return None
+        if error is not None: raise error
+        return results
+
+    def restart(self, workers):
+        for w in workers:
+            w.stop()
+            self.workers[self.workers.index(w)] = Worker(self.ctx)
+            self.stats["restarts"] += 1
+
+def start_pool(workers=None, threshold=10000):
+    "Starts a Pool and installs it as k.parallel."
+    stop_pool()
+    k.parallel = Pool(workers, threshold)
+    return k.parallel
+
+def stop_pool():
+    if k.parallel is not None:
+        k.parallel.close()
+        k.parallel = None
+
+@contextlib.contextmanager
+def pool(workers=None, threshold=10000):
+    "with pool() as p: ... runs the block with a Pool."
+    p = start_pool(workers, threshold)
+    try: yield p
+    finally: stop_pool()
+
+def tests():
+    import compiler, optimize
+    with optimize.disabled(): # so that the lambdas reach the pool, rather than becoming Fused kernels
+        srcs = ["{x*x}' !50", "{{x[<x]} x # 3 1 2}' 20 + !30", "f: {x+y}; {f[x; 1]}' !40", "+/ 30 2 # !60", "+\\ 30 2 # !60",
+                "*/ {1 2}' !30", "{x+y}/ !50", "{x}' ()"]
+        k.default.reset()
+        expected = [[k.eval(e) for e in parse.parse(src)][-1] for src in srcs]
+        with pool(workers=2, threshold=8) as p:
+            for src, want in zip(srcs, expected):
+                for run in (lambda: [k.eval(e) for e in parse.parse(src)][-1], lambda: compiler.run(src)):
+                    k.default.reset()
+                    got = run()
+                    assert got == want, (src, got, want)
+            k.default.reset()
+            assert [k.eval(e) for e in parse.parse("a: 0; {a: a + x}' !40; a")][-1] == Num(780) # stays serial
+            assert [k.eval(e) for e in parse.parse("a: 0; g: {a: a + x}; {g x}' !40; a")][-1] == Num(780) # so does this
+            assert p.stats["calls"] == 2 * 7, p.stats # not the lambda over, the empty each or the impure ones
+            assert p.stats["jobs sent"] < p.stats["chunks"] / 4 # each job went to each worker at most once
+            try: k.eval(parse.parse("{x+y}' !20")[0])
+            except k.LengthError: pass
+            else: assert False, "errors in workers are raised"
+            p.workers[0].proc.kill()
+            p.workers[0].proc.join()
+            calls = p.stats["calls"]
+            for _ in range(2): assert k.eval(parse.parse("{x*x}' !50")[0]) == expected[0]
+            assert p.stats["restarts"] == 1 and p.stats["calls"] == calls + 2 and p.stats["serial"] == 1, p.stats
+            k.eval(parse.parse("a: !10")[0])
+            hoisted = optimize.optimize(parse.parse("{x*+/a}' !40")[0]) # +/a is a Thunk until the pool forces it
+            assert k.eval(hoisted) == k.to_k([45 * i for i in range(40)]) and p.stats["calls"] == calls + 3, p.stats
+        assert k.parallel is None
+    print("parallel tests passed")
+
+def bench(n=5000, repeat=3):
+    "Times a CPU-bound each lambda serially and on pools of 1 to cpu_count workers."
+    expr = parse.parse("{+/{x*x}' x # 1 2 3}' %d # 30 40 50" % n)[0]
+    for workers in [0] + sorted({1, 2, os.cpu_count() or 1}):
+        if workers: start_pool(workers, threshold=1000)
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            k.eval(expr)
+            best = min(best, time.perf_counter() - start)
+        stop_pool()
+        print("%-8s %8.1fms" % ("serial" if not workers else "%d procs" % workers, best * 1e3))
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["bench"]: bench()
+    else: tests()
@@ -1,6 +1,6 @@
-# Use oK <https://github.com/JohnEarnest/ok> to parse K
+# Parse K natively, or with oK <https://github.com/JohnEarnest/ok> for cross-checking
 
-import subprocess, json, sys
+import subprocess, json, sys, re, string, os, pickle, hashlib, tempfile
 import k
 
 def ast(expr, raw=False):
@@ -36,11 +36,312 @@ def to_ast(v):
 
 	raise k.InternalError("to_ast: t=%d | %r" % (v['t'], v))
 
-def parse(expr):
+def parse_ok(expr):
+	"Parses expr by asking oK, for cross-checking the native parser."
 	return list(map(to_ast, ast(expr)))
 
+# Native parser
+
+def line_col(src, pos):
+	"Returns the 1-based line and column of the offset pos in src."
+	return src.count("\n", 0, pos) + 1, pos - (src.rfind("\n", 0, pos) + 1) + 1
+
+class ParseError(Exception):
+	def __init__(self, msg, src, pos):
+		self.msg, self.pos = msg, pos
+		self.line, self.col = line_col(src, pos)
+		Exception.__init__(self, "%s at line %d, column %d" % (msg, self.line, self.col))
+
+VERBS = "+-*%!&|<>=~,^#_$?@.:"
+ADVERBS = "/\\'"
+NAME_START = string.ascii_letters
+NAME_CHARS = string.ascii_letters + string.digits
+ESCAPES = {"n": "\n", "t": "\t", '"': '"', "\\": "\\"}
+number_re = re.compile(r"-?(\d+\.?\d*|\.\d+)([eE]-?\d+)?")
+
+def tokenize(src):
+	"Splits src into (kind, value, pos) tuples. kind is one of num, str, name, verb, adverb, punct or sep."
+	toks = []
+	i, n = 0, len(src)
+	def after_noun():
+		return toks and (toks[-1][0] in ("num", "str", "name") or toks[-1][0] == "punct" and toks[-1][1] in ")]}")
+	while i < n:
+		c = src[i]
+		spaced = i == 0 or src[i-1] in " \t\n"
+		if c == "/" and spaced: # comment until the end of the line
+			while i < n and src[i] != "\n": i += 1
+		elif c in " \t": i += 1
+		elif c in "\n;": toks.append(("sep", c, i)); i += 1
+		elif c in "()[]{}": toks.append(("punct", c, i)); i += 1
+		elif c == '"':
+			j, chars = i + 1, []
+			while j < n and src[j] != '"':
+				if src[j] == "\\":
+					j += 1
+					if j == n or src[j] not in ESCAPES: raise ParseError("bad escape", src, j)
+					chars.append(ESCAPES[src[j]])
+				else: chars.append(src[j])
+				j += 1
+			if j == n: raise ParseError("unterminated string", src, i)
+			toks.append(("str", "".join(chars), i)); i = j + 1
+		elif c in NAME_START:
+			j = i
+			while j < n and src[j] in NAME_CHARS: j += 1
+			toks.append(("name", src[i:j], i)); i = j
+		else:
+			m = number_re.match(src, i)
+			# a leading - belongs to the number unless it directly follows a noun, as in x-1
+			if m and (c != "-" or spaced or not after_noun()):
+				text = m.group(0)
+				v = float(text) if any(ch in text for ch in ".eE") else int(text)
+				toks.append(("num", v, i)); i = m.end()
+			elif c in ADVERBS:
+				j = i + 2 if i + 1 < n and src[i+1] == ":" else i + 1
+				toks.append(("adverb", src[i:j], i)); i = j
+			elif c in VERBS:
+				j = i + 2 if c != ":" and i + 1 < n and src[i+1] == ":" else i + 1
+				toks.append(("verb", src[i:j], i)); i = j
+			else: raise ParseError("unexpected character %r" % c, src, i)
+	return toks
+
+class Parser:
+	"A recursive descent parser producing the same k nodes as to_ast. K evaluates right to left, so a verb takes everything to its right as its argument."
+	def __init__(self, src):
+		self.src = src
+		self.toks = tokenize(src)
+		self.i = 0
+		self.names = [] # names referenced in each enclosing function, for implicit x, y and z arguments
+
+	def peek(self):
+		return self.toks[self.i] if self.i < len(self.toks) else (None, None, len(self.src))
+
+	def next(self):
+		tok = self.peek()
+		self.i += 1
+		return tok
+
+	def error(self, msg, tok=None):
+		raise ParseError(msg, self.src, (tok or self.peek())[2])
+
+	def at(self, *punct):
+		"Is the next token one of the given punctuation or separator characters?"
+		kind, value, _ = self.peek()
+		return kind in ("punct", "sep") and value in punct
+
+	def expect(self, value):
+		if not self.at(value): self.error("expected %r" % value)
+		return self.next()
+
+	def at_end(self):
+		return self.peek()[0] is None or self.at("\n", ";", ")", "]", "}")
+
+	def starts_noun(self):
+		return self.peek()[0] in ("num", "str", "name") or self.at("(", "{")
+
+	def statements(self, closer):
+		"Parses ; or newline separated expressions up to closer, or the end of input if closer is None. Empty statements are dropped."
+		body = []
+		while True:
+			e = self.expr()
+			if e is not None: body.append(e)
+			if self.at("\n", ";"): self.next()
+			elif closer is None and self.peek()[0] is None: return body
+			elif closer is not None and self.at(closer): self.next(); return body
+			elif self.peek()[0] is None: self.error("expected %r" % closer)
+			else: self.error("unexpected %r" % self.peek()[1])
+
+	def items(self, closer):
+		"Parses ; separated expressions up to closer, keeping empty ones as None."
+		items = [self.expr()]
+		while self.at(";", "\n"):
+			self.next()
+			items.append(self.expr())
+		self.expect(closer)
+		return items
+
+	def adverb(self):
+		if self.peek()[0] != "adverb": return None
+		tok = self.next()
+		if self.peek()[0] == "adverb": self.error("chained adverbs are not supported")
+		return tok[1]
+
+	def argument(self, tok):
+		r = self.expr()
+		if r is None: self.error("missing argument for %r" % tok[1], tok)
+		return r
+
+	def expr(self):
+		if self.at_end(): return None
+		if self.peek()[0] == "verb": # monad, or a bare verb
+			tok = self.next()
+			verb = self.verb(tok[1])
+			adv = self.adverb()
+			if adv: return k.AdverbMonadApply(adv, verb, self.argument(tok))
+			if self.at_end(): return verb
+			return k.MonadApply(verb.name, self.expr())
+		l = self.noun()
+		if self.peek()[0] == "adverb": # a noun modified by an adverb, like {x*y}/
+			tok = self.peek()
+			adv = self.adverb()
+			return k.AdverbMonadApply(adv, l, self.argument(tok))
+		if self.peek()[0] == "verb": # dyad
+			tok = self.next()
+			verb = self.verb(tok[1])
+			adv = self.adverb()
+			if adv: return k.AdverbDyadApply(adv, l, verb, self.argument(tok))
+			return k.DyadApply(l, verb.name, self.argument(tok))
+		if self.starts_noun(): # juxtaposition, like {x}1
+			return k.DyadApply(l, "@", self.expr())
+		return l
+
+	def verb(self, name):
+		if len(name) == 2 and name[1] == ":": return k.Verb(name[0], True)
+		return k.Verb(name, False)
+
+	def noun(self):
+		tok = self.next()
+		kind, value, _ = tok
+		if kind == "num":
+			nums = [k.Num(value)]
+			while self.peek()[0] == "num": nums.append(k.Num(self.next()[1]))
+			n = nums[0] if len(nums) == 1 else k.List(nums)
+		elif kind == "str":
+			n = k.Char(ord(value)) if len(value) == 1 else k.Str(value)
+		elif kind == "name":
+			if self.peek()[0] == "verb" and self.peek()[1] == ":": # assignment
+				colon = self.next()
+				after = self.peek()
+				if after[0] == "verb" and after[1] == ":" and after[2] == colon[2] + 1: # a view (name::expr)
+					return k.Depend(value, self.argument(self.next()))
+				v = self.argument(colon)
+				if k.is_(v, k.Function) and getattr(v, "name", None) is None: v.name = value # for profiles
+				return k.Assign(value, v)
+			if self.names: self.names[-1].add(value)
+			n = k.Var(value)
+		elif kind == "punct" and value == "(":
+			items = self.items(")")
+			if len(items) == 1: n = items[0] if items[0] is not None else k.List([])
+			elif None in items: self.error("empty list item", tok)
+			else: n = k.List(items)
+		elif kind == "punct" and value == "{":
+			n = self.function()
+			n.pos = line_col(self.src, tok[2])
+		elif kind is None: self.error("unexpected end of input", tok)
+		else: self.error("unexpected %r" % value, tok)
+		while self.at("["): # indexing or bracket application, like x[i] or f[x;y]
+			tok = self.next()
+			args = self.items("]")
+			if None in args and args != [None]: self.error("elided arguments are not supported", tok)
+			n = k.DyadApply(n, ".", k.List([a for a in args if a is not None]))
+		return n
+
+	def function(self):
+		args = None
+		if self.at("["): # explicit arguments, like {[a;b] a+b}
+			self.next()
+			args = []
+			while True:
+				tok = self.next()
+				if tok[0] != "name": self.error("expected an argument name", tok)
+				args.append(tok[1])
+				if self.at("]"): self.next(); break
+				self.expect(";")
+		self.names.append(set())
+		body = self.statements("}")
+		names = self.names.pop()
+		if args is None: # implicit arguments, up to the last of x, y and z used
+			args = ["x", "y", "z"][:max([1] + ["xyz".index(n) + 1 for n in names & {"x", "y", "z"}])]
+		if self.names: self.names[-1].update(names - set(args))
+		return k.Function(args, body)
+
+def parse(src):
+	"Parses a K script into a list of k nodes, one for each statement."
+	p = Parser(src)
+	return p.statements(None)
+
+# On-disk cache of parsed scripts. Entries are pickled node lists named by a hash of the source
+# and of the interpreter version, so an edited script or interpreter never sees a stale entry.
+
+CACHE_FORMAT = 2 # bump when the pickled node layout changes
+CACHE_MAGIC = b"kparse"
+
+def cache_dir():
+	"Where parse_cached keeps its entries: $K_CACHE_DIR, or ~/.cache/k."
+	return os.environ.get("K_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "k")
+
+_version = None
+def version():
+	"""Identifies this interpreter: the cache format, the Python version, whether NumPy is there,
+	and the size and modification time of the modules that define and build nodes."""
+	global _version
+	if _version is None:
+		parts = [CACHE_FORMAT, sys.version_info[:2], k.np is not None]
+		for mod in (k, sys.modules[__name__]):
+			st = os.stat(mod.__file__)
+			parts.append((st.st_size, st.st_mtime_ns))
+		_version = repr(parts).encode()
+	return _version
+
+def cache_key(src):
+	return hashlib.sha256(version() + b"\0" + src.encode("utf-8", "surrogatepass")).hexdigest()
+
+def parse_cached(src, directory=None):
+	"""Parses src like parse, reusing the nodes saved by an earlier call with the same source and
+	interpreter. Unreadable entries are reparsed and replaced; parse errors are not cached."""
+	key = cache_key(src)
+	path = os.path.join(directory or cache_dir(), key[:2], key + ".kpc")
+	try:
+		with open(path, "rb") as f:
+			data = f.read()
+		if data.startswith(CACHE_MAGIC + key.encode()):
+			return pickle.loads(data[len(CACHE_MAGIC) + len(key):])
+	except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError, TypeError):
+		pass
+	exprs = parse(src)
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+		with os.fdopen(fd, "wb") as f:
+			f.write(CACHE_MAGIC + key.encode() + pickle.dumps(exprs, pickle.HIGHEST_PROTOCOL))
+		os.replace(tmp, path) # atomic, so concurrent readers see the old entry or the new one
+	except OSError:
+		pass # a read-only or full disk only costs the reparse
+	return exprs
+
+def load(path, directory=None):
+	"Reads and parses the K script in the file at path, through the cache."
+	with open(path, encoding="utf-8") as f:
+		return parse_cached(f.read(), directory)
+
+def tests():
+	N, L, C, V = k.Num, k.List, k.Char, k.Var
+	assert parse("1+2") == [k.DyadApply(N(1), "+", N(2))]
+	assert parse("1 -2") == [L([N(1), N(-2)])]
+	assert parse("x-1") == [k.DyadApply(V("x"), "-", N(1))]
+	assert parse('1_"c"') == [k.DyadApply(N(1), "_", C(99))]
+	assert parse("-:' 1 2") == [k.AdverbMonadApply("'", k.Verb("-", True), L([N(1), N(2)]))]
+	assert parse("{x*y}/ 1 2") == [k.AdverbMonadApply("/", k.Function(["x", "y"], [k.DyadApply(V("x"), "*", V("y"))]), L([N(1), N(2)]))]
+	assert parse("x[<x]") == [k.DyadApply(V("x"), ".", L([k.MonadApply("<", V("x"))]))]
+	assert parse("a: 1; a\n/ comment\n()") == [k.Assign("a", N(1)), V("a"), L([])]
+	assert parse("a::b+1; a: :b") == [k.Depend("a", k.DyadApply(V("b"), "+", N(1))), k.Assign("a", k.MonadApply(":", V("b")))]
+	for src, pos in [("1+", 1), ("(1;2", 4), ('"ab', 0), ("1 2)", 3)]:
+		try: parse(src)
+		except ParseError as e: assert e.pos == pos, (src, e)
+		else: assert False, src
+	with tempfile.TemporaryDirectory() as d:
+		src = "sq: {x*x}; sq' !5"
+		exprs = parse_cached(src, d)
+		assert exprs == parse(src) and exprs[0].v.name == "sq"
+		entry = os.path.join(d, cache_key(src)[:2], cache_key(src) + ".kpc")
+		assert os.path.exists(entry) and parse_cached(src, d) == exprs
+		with open(entry, "wb") as f: f.write(b"garbage")
+		assert parse_cached(src, d) == exprs # a corrupt entry is replaced
+		assert parse_cached(src + "+1", d) != exprs
+	print("parse tests passed")
+
 def main():
 	#print(parse("1 # 1 2 3"))
-	print(parse(sys.argv[1]))
+	if len(sys.argv) < 2: tests()
+	else: print(parse(sys.argv[1]))
 
 if __name__ == "__main__": main()
\ No newline at end of file
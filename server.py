@@ -0,0 +1,241 @@
+# Serve K evaluations over TCP from a pool of warm worker processes.
+#
+#   python server.py --port 7777 --workers 4 --cpu 5
+#   python server.py test
+#
+# Clients send line-delimited JSON requests {"id": ..., "src": "..."}, optionally with "cpu" to
+# lower the CPU-time limit, and get back one line per request, in order, with either "value" (or
+# "repr" for values with no JSON form) or "error". A connection is a session: its variables
+# persist between its requests and are invisible to other connections. Requests may be pipelined;
+# a session's requests run one after another, and different sessions run in parallel.
+
+import argparse, asyncio, json, math, multiprocessing, signal, sys, itertools
+import k, parse
+
+class CPULimit(Exception): pass
+
+def on_sigprof(signum, frame):
+    raise CPULimit("CPU time limit exceeded")
+
+def encode(v):
+    try: return {"value": k.from_k(v)}
+    except k.InternalError: return {"repr": repr(v)}
+
+def worker_main(conn):
+    """Runs in each worker process: evaluates ("eval", session, src, cpu) messages in the session's
+    Interpreter and drops sessions on ("close", session)."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the server shuts workers down
+    signal.signal(signal.SIGPROF, on_sigprof)
+    k.Interpreter().run(parse.parse("+/{x*2}' !10")) # warm up
+    sessions = {}
+    while True:
+        try: msg = conn.recv()
+        except EOFError: return
+        if msg[0] == "close":
+            sessions.pop(msg[1], None)
+            continue
+        _, session, src, cpu = msg
+        interp = sessions.get(session)
+        if interp is None: interp = sessions[session] = k.Interpreter()
+        try:
+            exprs = parse.parse(src)
+            signal.setitimer(signal.ITIMER_PROF, cpu) # counts this process's CPU time
+            try: r = encode(interp.run(exprs))
+            finally: signal.setitimer(signal.ITIMER_PROF, 0)
+        except CPULimit as e: r = {"error": str(e)}
+        except RecursionError: r = {"error": "stack overflow"}
+        except Exception as e: r = {"error": "%s: %s" % (type(e).__name__, e)}
+        conn.send(r)
+
+class Worker:
+    """A worker process and the pipe to it. One request is in flight at a time; if the worker
+    doesn't answer within the wall-clock limit (stuck outside Python, where the CPU limit can't
+    interrupt it) or dies, it is restarted and loses its sessions. The session whose request that
+    was is told so in the answer, and the others, in lost, by an error in place of the answer to
+    their next request."""
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.lock = asyncio.Lock()
+        self.sessions = set()
+        self.lost = set() # sessions whose variables went with a restart they haven't been told of
+        self.restarts = 0
+        self.start()
+
+    def start(self):
+        self.conn, child = self.ctx.Pipe()
+        self.proc = self.ctx.Process(target=worker_main, args=(child,), daemon=True)
+        self.proc.start()
+        child.close()
+
+    def stop(self):
+        self.proc.kill()
+        self.proc.join()
+        self.conn.close()
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.lost |= self.sessions
+        self.sessions.clear()
+        self.start()
+
+    def call(self, msg, timeout):
+        "Blocking: sends msg and waits for the answer. Run in a thread."
+        try:
+            self.conn.send(msg)
+            if self.conn.poll(timeout): return self.conn.recv()
+            error = "timed out, session reset"
+        except (EOFError, OSError):
+            error = "worker crashed, session reset"
+        self.restart()
+        return {"error": error}
+
+    async def eval(self, session, src, cpu):
+        async with self.lock:
+            self.sessions.add(session) # again, if a restart dropped it
+            if session in self.lost:
+                self.lost.discard(session)
+                return {"error": "session reset: another session's request restarted the worker"}
+            r = await asyncio.get_running_loop().run_in_executor(None, self.call, ("eval", session, src, cpu), cpu * 2 + 5)
+            self.lost.discard(session) # if this restarted the worker, r says so
+            return r
+
+    async def close(self, session):
+        async with self.lock:
+            self.lost.discard(session)
+            if session in self.sessions:
+                self.sessions.discard(session)
+                try: self.conn.send(("close", session))
+                except OSError: pass # a dead worker is restarted by the next eval
+
+class Server:
+    def __init__(self, workers=4, cpu=5.0):
+        self.cpu = cpu
+        self.nworkers = workers
+        self.workers = []
+        self.sessions = set() # tasks serving connections
+        self.ids = itertools.count()
+
+    async def start(self, host="127.0.0.1", port=7777):
+        ctx = multiprocessing.get_context("spawn") # forking a process running an event loop isn't safe
+        self.workers = [Worker(ctx) for _ in range(self.nworkers)]
+        self.server = await asyncio.start_server(self.session, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        self.server.close()
+        for task in self.sessions: task.cancel()
+        await asyncio.gather(*self.sessions, return_exceptions=True)
+        await self.server.wait_closed()
+        for w in self.workers: w.stop()
+
+    async def session(self, reader, writer):
+        "Serves one connection: reads requests as they come, and answers them in order."
+        sid = next(self.ids)
+        self.sessions.add(asyncio.current_task())
+        worker = min(self.workers, key=lambda w: len(w.sessions)) # the least busy
+        worker.sessions.add(sid)
+        queue = asyncio.Queue()
+        async def answer():
+            while True:
+                req = await queue.get()
+                if req is None: return
+                writer.write((json.dumps(await self.handle(worker, sid, req)) + "\n").encode())
+                await writer.drain()
+        answering = asyncio.create_task(answer())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line: break
+                await queue.put(line)
+            await queue.put(None)
+            await answering
+        except (ConnectionError, asyncio.CancelledError):
+            answering.cancel()
+        finally:
+            self.sessions.discard(asyncio.current_task())
+            await worker.close(sid)
+            writer.close()
+
+    async def handle(self, worker, sid, line):
+        try:
+            req = json.loads(line)
+            src = req["src"]
+            cpu = float(req.get("cpu", self.cpu))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return {"id": None, "error": "bad request"}
+        if not 0 < cpu < math.inf: # 0 would disarm the timer, and NaN fails every comparison
+            return {"id": req.get("id"), "error": "bad request: cpu must be a positive number of seconds"}
+        cpu = min(cpu, self.cpu)
+        r = await worker.eval(sid, src, cpu)
+        r["id"] = req.get("id")
+        return r
+
+async def client(port, requests):
+    "Sends requests on one connection without waiting for answers, then returns the answers."
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for req in requests: writer.write((json.dumps(req) + "\n").encode())
+    await writer.drain()
+    answers = [json.loads(await reader.readline()) for _ in requests]
+    writer.close()
+    return answers
+
+async def connect(port):
+    "Opens a session, returning a coroutine function that sends one K source and returns its answer, and the writer."
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    async def ask(src):
+        writer.write((json.dumps({"src": src}) + "\n").encode())
+        await writer.drain()
+        return json.loads(await reader.readline())
+    return ask, writer
+
+def tests():
+    async def run():
+        server = Server(workers=2, cpu=1.0)
+        port = await server.start(port=0)
+        try:
+            a, b = await asyncio.gather(
+                client(port, [{"id": 1, "src": "a: 1 2 3"}, {"id": 2, "src": "+/a*2"}, {"id": 3, "src": "b"},
+                              {"id": 4, "src": "{x+1}/ 0", "cpu": 0.3}, {"id": 5, "src": "a"}]),
+                client(port, [{"id": 1, "src": "a"}, {"id": 2, "src": "a: \"xy\"; #a"}, {"id": 3, "src": "1+"}]))
+            assert [r.get("value") for r in a] == [[1, 2, 3], 12, None, None, [1, 2, 3]], a
+            assert "Unbound" in a[2]["error"] and "CPU" in a[3]["error"] and [r["id"] for r in a] == [1, 2, 3, 4, 5]
+            assert "Unbound" in b[0]["error"] and b[1]["value"] == 2 and "ParseError" in b[2]["error"], b
+            c = await client(port, [{"id": i, "src": "{x+1}/ 0", "cpu": cpu} for i, cpu in enumerate([0, -1, "nan", "inf"])])
+            assert all("bad request" in r["error"] for r in c) and [r["id"] for r in c] == [0, 1, 2, 3], c
+        finally:
+            await server.close()
+        server = Server(workers=1, cpu=1.0) # two sessions on one worker, which dies
+        port = await server.start(port=0)
+        try:
+            (a, wa), (b, wb) = await connect(port), await connect(port)
+            assert (await a("x: 1"))["value"] == 1 and (await b("y: 2"))["value"] == 2
+            server.workers[0].proc.kill()
+            assert "worker crashed" in (await a("x"))["error"]
+            assert "session reset" in (await b("y"))["error"] # told once, then it starts afresh
+            assert "Unbound" in (await b("y"))["error"] and (await b("y: 3"))["value"] == 3
+            assert "Unbound" in (await a("x"))["error"] and server.workers[0].restarts == 1 and not server.workers[0].lost
+            wa.close()
+            wb.close()
+        finally:
+            await server.close()
+    asyncio.run(run())
+    print("server tests passed")
+
+def main():
+    if sys.argv[1:] == ["test"]: return tests()
+    p = argparse.ArgumentParser(description="Serve K evaluations over TCP")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=7777)
+    p.add_argument("--workers", type=int, default=4, help="number of worker processes")
+    p.add_argument("--cpu", type=float, default=5.0, help="CPU seconds allowed per request")
+    args = p.parse_args()
+    async def serve():
+        server = Server(args.workers, args.cpu)
+        port = await server.start(args.host, args.port)
+        print("serving on %s:%d" % (args.host, port))
+        await server.server.serve_forever()
+    try: asyncio.run(serve())
+    except KeyboardInterrupt: pass
+
+if __name__ == "__main__": main()